@@ -1,27 +1,673 @@
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import importlib.util
+import json
 import logging
+import os
+import pstats
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+import zlib
 
 import sys
-from typing import Any, Optional, List, Dict
-from errbot.backends.base import RoomError, Identifier, Person, RoomOccupant, Room, Message, ONLINE
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Any, Optional, List, Dict, Iterable, Iterator, Callable, Awaitable, Union
+from errbot.backends.base import RoomError, Identifier, Person, RoomOccupant, Room, Message, ONLINE, OFFLINE, AWAY, \
+    DND
+from errbot import botcmd
 from errbot.core import ErrBot
 
 log = logging.getLogger('errbot.backends.matrix-nio')
 try:
-    from nio import LoginError, AsyncClientConfig, RoomSendResponse, ErrorResponse, JoinedRoomsError, RoomForgetError, \
-        MatrixRoom
     import asyncio
-    import nio
 except ImportError:
     log.exception("Could not start the Matrix Nio back-end")
-    log.error(
-        "You need to install the Matrix Nio support in order "
-        "to use the Matrix Nio backend.\n"
-        "You should be able to install this package using:\n"
-        "pip install matrix-nio"
-    )
+    log.error("asyncio is required by the Matrix Nio backend")
     sys.exit(1)
 
 
+def _lazy_import(name: str) -> Any:
+    """
+    Imports a module whose code only runs on its first attribute access
+    :return: the module, None if it is not installed
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        return None
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+if TYPE_CHECKING:
+    import nio
+else:
+    # nio pulls in olm, peewee, aiohttp and jsonschema: it is only loaded once the backend
+    # actually starts, not when errbot merely lists its backends or tests are collected.
+    # Annotations naming nio types are strings so that defining the functions does not load it.
+    nio = _lazy_import('nio')
+_nio_loaded = False
+# The classes extending nio, by name
+_nio_classes = {}  # type: Dict[str, type]
+
+
+def _load_nio() -> None:
+    """
+    Loads nio and defines the classes extending it, exits if it is not installed
+    """
+    global _nio_loaded
+    if _nio_loaded:
+        return
+    try:
+        if nio is None:
+            raise ImportError("nio is required")
+        # Runs the lazily imported module
+        nio.AsyncClient
+    except ImportError:
+        log.exception("Could not start the Matrix Nio back-end")
+        log.error(
+            "You need to install the Matrix Nio support in order "
+            "to use the Matrix Nio backend.\n"
+            "You should be able to install this package using:\n"
+            "pip install matrix-nio"
+        )
+        sys.exit(1)
+    _nio_classes.update(_define_nio_classes())
+    globals().update(_nio_classes)
+    _nio_loaded = True
+
+
+def _new_event_loop(name: Optional[str] = None) -> asyncio.AbstractEventLoop:
+    """
+    Creates an event loop of the given implementation, 'asyncio' or 'uvloop'
+    """
+    if name == 'uvloop':
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            log.warning("uvloop is not installed, falling back to the asyncio event loop")
+    elif name not in (None, 'asyncio'):
+        raise ValueError(f"Unknown event loop {name}, expected 'asyncio' or 'uvloop'")
+    return asyncio.new_event_loop()
+
+
+def __getattr__(name: str) -> Any:
+    # Python 3.7+, call _load_nio first on older versions
+    if name in ('MatrixNioStoredUser', 'MatrixNioCompactRoom', 'MatrixNioClient'):
+        _load_nio()
+        return _nio_classes[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Sync responses can weigh several MB, use the fastest JSON decoder available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads  # type: ignore
+    except ImportError:
+        json_loads = json.loads  # type: ignore
+
+
+# Matrix only knows about these three presence states
+PRESENCE_MAPPING = {
+    ONLINE: "online",
+    OFFLINE: "offline",
+    AWAY: "unavailable",
+    DND: "unavailable",
+}
+
+
+def _read_json(path: str, default: Any = None) -> Any:
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return default
+    except ValueError:
+        log.exception(f"Corrupted state file {path} ignored")
+        return default
+
+
+def _write_json(path: str, data: Any) -> None:
+    # Write then rename so that a crash never leaves a truncated file behind
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as json_file:
+        json.dump(data, json_file)
+    os.replace(temporary_path, path)
+
+
+# Leader and workers exchange one JSON document per line
+IPC_LINE_LIMIT = 16 * 1024 * 1024
+# Events fetched per request when paginating the messages missed while the bot was down
+CATCH_UP_PAGE_SIZE = 100
+
+
+def _write_line(writer: asyncio.StreamWriter, data: dict) -> None:
+    writer.write(json.dumps(data).encode() + b"\n")
+
+
+def _in_flight(requests: Dict[Any, asyncio.Future], key: Any, start: Callable[[], Awaitable]) -> Awaitable:
+    """
+    Joins the request pending under `key` in `requests`, or starts it with `start`.
+    The request is dropped from `requests` once done, so its result is not cached.
+    """
+    request = requests.get(key)
+    if request is None:
+        request = asyncio.ensure_future(start())
+        requests[key] = request
+        request.add_done_callback(lambda _: requests.pop(key, None))
+    # A cancelled caller does not cancel the request shared with the others
+    return asyncio.shield(request)
+
+
+def _single_flight(method: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """
+    Wraps a read request of the client: concurrent identical calls share a single request
+    """
+
+    @functools.wraps(method)
+    async def single_flight(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())), asyncio.get_event_loop())
+        return await _in_flight(self._requests_in_flight, key, lambda: method(self, *args, **kwargs))
+
+    return single_flight
+
+
+class MatrixNioEventDeduplicator(object):
+    """
+    Remembers the event_id of recently processed events, within a bounded size and time window.
+    """
+
+    def __init__(self, max_size: int = 10000, window: float = 3600):
+        self._max_size = max_size
+        self._window = window
+        # event_id -> time it was first seen, oldest first
+        self._events = OrderedDict()  # type: OrderedDict
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._events
+
+    def seen(self, event_id: str) -> bool:
+        """
+        Records an event
+        :return: True if the event was already recorded
+        """
+        now = time.time()
+        self._expire(now)
+        if event_id in self._events:
+            return True
+        self._events[event_id] = now
+        if len(self._events) > self._max_size:
+            self._events.popitem(last=False)
+        return False
+
+    def _expire(self, now: float) -> None:
+        limit = now - self._window
+        while self._events:
+            event_id, timestamp = next(iter(self._events.items()))
+            if timestamp >= limit:
+                break
+            del self._events[event_id]
+
+    def load(self, path: str) -> None:
+        for event_id, timestamp in _read_json(path, []):
+            self._events[event_id] = timestamp
+        self._expire(time.time())
+
+    def save(self, path: str) -> None:
+        _write_json(path, list(self._events.items()))
+
+
+class MatrixNioCache(object):
+    """
+    Least recently used cache, each entry expiring after `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self._max_size = max_size
+        self._ttl = ttl
+        # key -> (value, expiration time), least recently used first
+        self._entries = OrderedDict()  # type: OrderedDict
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        self._entries[key] = (value, time.monotonic() + self._ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+class MatrixNioAliasCache(MatrixNioCache):
+    """
+    Least recently used cache of room alias -> room_id resolutions, each one expiring after `ttl` seconds.
+    """
+
+
+class MatrixNioSendScheduler(object):
+    """
+    Schedules outbound messages within a global rate budget.
+
+    A token bucket refilled at `rate` messages per second, holding at most `burst` tokens, caps the sending
+    rate. Rooms take turns (round-robin) with at most one message in flight per room, so that a noisy
+    room cannot starve the others. Rooms with a priority message pending go before the others, but the
+    messages of a room are always sent in order.
+    """
+
+    def __init__(self, rate: float, burst: int = 10, concurrency: int = 10):
+        self._rate = rate
+        self._burst = burst
+        self._concurrency = concurrency
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        # room_id -> pending sends of the room, in round-robin order
+        self._queues = OrderedDict()  # type: OrderedDict
+        # room_id -> priority sends pending in the room, the rooms served first
+        self._priority = OrderedDict()  # type: OrderedDict
+        self._in_flight = set()  # type: set
+        self._wakeup = None  # type: Optional[asyncio.Event]
+        self._worker = None  # type: Optional[asyncio.Task]
+        # room_id -> [messages sent, total wait, max wait]
+        self._waits = {}  # type: Dict[str, List[float]]
+
+    async def submit(self, room_id: str, send: Callable[[], Awaitable], priority: bool = False) -> Any:
+        """
+        Queues `send` and waits for its result
+        """
+        future = asyncio.get_event_loop().create_future()
+        item = (room_id, send, future, time.monotonic(), priority)
+        self._queues.setdefault(room_id, deque()).append(item)
+        if priority:
+            self._priority[room_id] = self._priority.get(room_id, 0) + 1
+        self._wake()
+        if self._worker is None:
+            self._worker = asyncio.ensure_future(self._run())
+        return await future
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Wait time before sending, per room
+        :return: room_id -> {'sent', 'average_wait', 'max_wait'}, waits in seconds
+        """
+        return {
+            room_id: {'sent': sent, 'average_wait': total / sent, 'max_wait': maximum}
+            for room_id, (sent, total, maximum) in self._waits.items()
+        }
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _next(self) -> Optional[tuple]:
+        for room_id in list(self._priority) + list(self._queues):
+            if room_id not in self._in_flight:
+                return self._pop(room_id)
+        return None
+
+    def _pop(self, room_id: str) -> tuple:
+        queue = self._queues.pop(room_id)
+        item = queue.popleft()
+        if queue:
+            # Back of the line
+            self._queues[room_id] = queue
+        if item[4]:
+            self._priority[room_id] -= 1
+            if not self._priority[room_id]:
+                del self._priority[room_id]
+        return item
+
+    async def _acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    async def _run(self) -> None:
+        self._wakeup = asyncio.Event()
+        try:
+            while self.pending() or self._in_flight:
+                item = self._next() if len(self._in_flight) < self._concurrency else None
+                if item is None:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if item[2].cancelled():
+                    # Given up while queued, e.g. a timed out broadcast
+                    continue
+                await self._acquire()
+                room_id, send, future, queued, _ = item
+                self._record_wait(room_id, time.monotonic() - queued)
+                self._in_flight.add(room_id)
+                task = asyncio.ensure_future(send())
+                task.add_done_callback(lambda task, room_id=room_id, future=future: self._done(room_id, future, task))
+        finally:
+            self._worker = None
+
+    def _done(self, room_id: str, future: asyncio.Future, task: asyncio.Future) -> None:
+        self._in_flight.discard(room_id)
+        self._wake()
+        if future.cancelled():
+            return
+        if task.cancelled():
+            future.cancel()
+            return
+        exception = task.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(task.result())
+
+    def _record_wait(self, room_id: str, wait: float) -> None:
+        waits = self._waits.setdefault(room_id, [0, 0.0, 0.0])
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+
+
+class MatrixNioProfiler(object):
+    """
+    Wall clock time spent in each stage of the backend, and on-demand cProfile sessions.
+    A cProfile session only covers the threads it was started from.
+    """
+    _NO_SPAN = contextlib.suppress()
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._spans = {}  # type: Dict[str, list]
+        self._profiles = {}  # type: Dict[int, cProfile.Profile]
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        """
+        Context manager timing a stage, free when the profiler is disabled
+        """
+        if not self.enabled:
+            return self._NO_SPAN
+        return self._span(name)
+
+    @contextlib.contextmanager
+    def _span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, duration: float) -> None:
+        with self._lock:
+            span = self._spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += duration
+            span[2] = max(span[2], duration)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: stage -> {'count', 'total', 'average', 'max'}, in seconds
+        """
+        with self._lock:
+            return {
+                name: {'count': count, 'total': total, 'average': total / count, 'max': maximum}
+                for name, (count, total, maximum) in self._spans.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._spans = {}
+
+    @property
+    def profiling(self) -> bool:
+        return bool(self._profiles)
+
+    def start_profile(self) -> None:
+        """
+        Starts profiling the calling thread
+        """
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles[threading.get_ident()] = profile
+        profile.enable()
+
+    def stop_profile(self) -> None:
+        """
+        Stops profiling the calling thread
+        """
+        profile = self._profiles.get(threading.get_ident())
+        if profile is not None:
+            profile.disable()
+
+    def dump_profile(self, path: str) -> None:
+        """
+        Merges the profiles of every thread into a pstats file, once they are stopped
+        """
+        with self._lock:
+            profiles, self._profiles = list(self._profiles.values()), {}
+        if not profiles:
+            raise ValueError("No profile to save")
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+
+class MatrixNioSyncTimeout(object):
+    """
+    Adaptive long-poll timeout of the syncs: back to `min_timeout` ms as soon as a sync brings events,
+    so that bursts are delivered by short syncs back to back, doubled after every empty sync up to
+    `max_timeout` ms when idle.
+    """
+
+    def __init__(self, min_timeout: int = 1000, max_timeout: int = 30000):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout = max_timeout
+
+    def update(self, activity: bool) -> None:
+        if activity:
+            self.timeout = self.min_timeout
+        else:
+            self.timeout = min(self.max_timeout, max(self.timeout * 2, 1))
+
+
+class MatrixNioLoopWatchdog(object):
+    """
+    Measures how late the event loop wakes up a coroutine sleeping `interval` seconds, and logs
+    the stack of the loop thread whenever it is blocked for more than `threshold` seconds.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.5, samples: int = 1000, stalls: int = 10):
+        self.interval = interval
+        self.threshold = threshold
+        self._lags = deque(maxlen=samples)  # type: deque
+        self.stalls = deque(maxlen=stalls)  # type: deque
+        self._last_beat = None  # type: Optional[float]
+        self._reported_beat = None  # type: Optional[float]
+
+    async def run(self) -> None:
+        """
+        Heartbeat of the loop, watched from a separate thread until cancelled
+        """
+        stopped = threading.Event()
+        threading.Thread(target=self._watch, args=(stopped, threading.get_ident()),
+                         name="matrix-nio-watchdog", daemon=True).start()
+        try:
+            while True:
+                self._last_beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._lags.append(max(0.0, time.monotonic() - self._last_beat - self.interval))
+        finally:
+            self._last_beat = None
+            stopped.set()
+
+    def _watch(self, stopped: threading.Event, loop_thread_id: int) -> None:
+        while not stopped.wait(self.threshold / 2):
+            beat = self._last_beat
+            if beat is None or beat == self._reported_beat:
+                continue
+            blocked = time.monotonic() - beat - self.interval
+            if blocked > self.threshold:
+                # Reported once per stall
+                self._reported_beat = beat
+                frame = sys._current_frames().get(loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                self.stalls.append({'time': time.time(), 'blocked': blocked, 'stack': stack})
+                log.warning(f"Event loop blocked for more than {blocked:.3f}s in:\n{stack}")
+
+    def percentiles(self) -> Dict[str, float]:
+        """
+        :return: {'p50', 'p90', 'p99', 'max'} of the recent lags in seconds, empty without samples
+        """
+        lags = sorted(self._lags)
+        if not lags:
+            return {}
+        result = {f"p{percentile}": lags[min(len(lags) - 1, len(lags) * percentile // 100)]
+                  for percentile in (50, 90, 99)}
+        result['max'] = lags[-1]
+        return result
+
+
+class MatrixNioCommands(object):
+    """
+    Commands of the Matrix Nio backend, reserved to the bot admins
+    """
+    name = 'MatrixNio'
+    __errdoc__ = "Diagnostics of the Matrix Nio backend"
+
+    def __init__(self, backend: "MatrixNioBackend"):
+        self._backend = backend
+
+    @botcmd(admin_only=True)
+    def matrix_profile(self, msg: Message, args: str) -> str:
+        """
+        Time spent per stage, `reset` it, or `start`/`stop` a cProfile session saved in BOT_DATA_DIR
+        """
+        profiler = self._backend.profiler
+        if args == 'start':
+            if self._backend.profiling:
+                return "Already profiling"
+            self._backend.start_profiling()
+            return "Profiling started"
+        if args == 'stop':
+            if not self._backend.profiling:
+                return "Not profiling"
+            return f"Saving the profile to {self._backend.stop_profiling()}"
+        if args == 'reset':
+            profiler.reset()
+            return "Timings reset"
+        if not profiler.enabled:
+            return "Profiling is disabled, set MATRIX_NIO_PROFILING to enable it"
+        lines = ["| Stage | Count | Total (s) | Average (ms) | Max (ms) |", "|---|---|---|---|---|"]
+        for name, span in sorted(profiler.stats().items()):
+            lines.append(f"| {name} | {span['count']} | {span['total']:.3f} "
+                         f"| {span['average'] * 1000:.2f} | {span['max'] * 1000:.2f} |")
+        return "\n".join(lines)
+
+    @botcmd(admin_only=True)
+    def matrix_lag(self, msg: Message, args: str) -> str:
+        """
+        Event loop lag percentiles, and the stack of the latest stall
+        """
+        watchdog = self._backend.watchdog
+        if watchdog is None:
+            return "The watchdog is disabled, set MATRIX_NIO_LOOP_WATCHDOG to enable it"
+        percentiles = watchdog.percentiles()
+        if not percentiles:
+            return "No lag measured yet"
+        result = ", ".join(f"{name}: {lag * 1000:.1f} ms" for name, lag in percentiles.items())
+        if watchdog.stalls:
+            stall = watchdog.stalls[-1]
+            result += (f"\n{len(watchdog.stalls)} recent stalls, the latest one blocked the loop for "
+                       f"{stall['blocked']:.3f}s at {time.ctime(stall['time'])} in:\n```\n{stall['stack']}```")
+        return result
+
+
+class MatrixNioRecorder(object):
+    """
+    Appends sync responses and sent messages to a gzip compressed log, one JSON document per line.
+    Records are buffered and every flush appends a complete gzip member, so that the log stays
+    readable up to the last flush when the bot is killed. The members read back as a single stream.
+    """
+    FLUSH_SIZE = 1024 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._buffer = []  # type: List[str]
+        self._buffered = 0
+
+    def record(self, record_type: str, **data: Any) -> None:
+        data['type'] = record_type
+        data['time'] = time.time()
+        line = json.dumps(data) + "\n"
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            data, self._buffer, self._buffered = "".join(self._buffer), [], 0
+            self._file.write(gzip.compress(data.encode('utf-8')))
+        self._file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+    @staticmethod
+    def read(path: str) -> Iterator[dict]:
+        """
+        Reads a log back, a record cut short at the end of the log is skipped
+        """
+        with gzip.open(path, 'rt', encoding='utf-8') as log_file:
+            try:
+                for line in log_file:
+                    try:
+                        record = json_loads(line)
+                    except ValueError:
+                        log.warning(f"Skipping the truncated last record of {path}")
+                        return
+                    yield record
+            except (EOFError, OSError, zlib.error):
+                log.warning(f"Skipping the truncated end of {path}")
+
+
 class MatrixNioRoomError(RoomError):
     def __init__(self, message: str = None):
         if message is None:
@@ -54,11 +700,13 @@ class MatrixNioIdentifier(Identifier):
 
 # `MatrixNioPerson` is used for both 1-1 PMs and Group PMs.
 class MatrixNioPerson(MatrixNioIdentifier, Person):
-    def __init__(self, an_id: str, client: nio.Client, full_name: str, emails: Optional[List[str]] = None):
+    def __init__(self, an_id: str, client: "nio.Client", full_name: str, emails: Optional[List[str]] = None):
         super().__init__(an_id)
         self._full_name = full_name
         self._emails = emails
         self._client = client
+        # errbot checks ACLs on every command, compute them once
+        self._aclattr = ','.join(sorted(emails)) if emails else ""
 
     @property
     def person(self) -> str:
@@ -85,7 +733,7 @@ class MatrixNioPerson(MatrixNioIdentifier, Person):
         return self._full_name
 
     @property
-    def client(self) -> nio.Client:
+    def client(self) -> "nio.Client":
         """
         Maps to AsyncClient
         :return: AsyncClient
@@ -106,26 +754,28 @@ class MatrixNioPerson(MatrixNioIdentifier, Person):
         Maps to ProfileGetResponse.other_info['address']
         :return: ProfileGetResponse.other_info['address']
         """
-        if self.emails:
-            return ','.join(sorted(self.emails))
-        else:
-            return ""
+        return self._aclattr
 
 
 class MatrixNioRoom(MatrixNioIdentifier, Room):
-    def __init__(self, an_id: str, client: nio.Client, title: str, subject: str = None):
+    def __init__(self, an_id: str, client: "nio.Client", title: str, subject: str = None,
+                 backend: Optional["MatrixNioBackend"] = None):
         super().__init__(an_id)
         self._title = title
         self._subject = subject
         self._client = client
+        # Runs the requests of the blocking properties and methods on its loop
+        self._backend = backend
         self.matrix_room = self._client.rooms[an_id]
 
     @classmethod
-    def from_matrix_room(cls, matrix_room: MatrixRoom, nio_client: nio.Client):
+    def from_matrix_room(cls, matrix_room: "nio.MatrixRoom", nio_client: "nio.Client",
+                         backend: Optional["MatrixNioBackend"] = None):
         room = cls(
             matrix_room.room_id,
             nio_client,
-            matrix_room.topic
+            matrix_room.topic,
+            backend=backend
         )
         room.matrix_room = matrix_room
         return room
@@ -141,10 +791,10 @@ class MatrixNioRoom(MatrixNioIdentifier, Room):
     @property
     def aclattr(self) -> str:
         """
-        Maps to MatrixRoom.own_user_id
-        :return: MatrixRoom.own_user_id
+        Maps to MatrixRoom.room_id
+        :return: MatrixRoom.room_id
         """
-        return self.matrix_room.own_user_id
+        return self._id
 
     @property
     def subject(self) -> str:
@@ -167,16 +817,22 @@ class MatrixNioRoom(MatrixNioIdentifier, Room):
         rooms_list = list(self._client.rooms.keys())
         return self.id in rooms_list
 
+    def _run_blocking(self, coroutine) -> Any:
+        if self._backend is None:
+            coroutine.close()
+            raise ValueError(f"Room {self.id} is not bound to a backend, its requests must be awaited")
+        return self._backend._run_blocking(coroutine)
+
     @property
     def joined(self) -> bool:
-        joined_rooms = asyncio.get_event_loop().run_until_complete(self._client.joined_rooms())
-        if isinstance(joined_rooms, JoinedRoomsError):
+        joined_rooms = self._run_blocking(self._client.joined_rooms())
+        if isinstance(joined_rooms, nio.JoinedRoomsError):
             raise ValueError(f"Error while fetching joined rooms {joined_rooms}")
         return self.id in joined_rooms.rooms
 
     def destroy(self) -> None:
-        result = asyncio.get_event_loop().run_until_complete(self._client.room_forget(self.id))
-        if isinstance(result, RoomForgetError):
+        result = self._run_blocking(self._client.room_forget(self.id))
+        if isinstance(result, nio.RoomForgetError):
             raise ValueError(f"Error while forgetting/destroying room {result}")
 
     async def join(self, username: str = None, password: str = None) -> None:
@@ -216,7 +872,7 @@ class MatrixNioRoom(MatrixNioIdentifier, Room):
         """
         users = self.matrix_room.users
         occupants = []
-        for i in users:
+        for i in users.values():
             an_occupant = MatrixNioRoomOccupant(i.user_id, full_name=i.display_name, client=self._client)
             occupants.append(an_occupant)
         return occupants
@@ -238,127 +894,1767 @@ class MatrixNioRoomOccupant(MatrixNioPerson, RoomOccupant):
     def __init__(self,
                  an_id: str,
                  full_name: str,
-                 client: nio.Client,
+                 client: "nio.Client",
                  emails: Optional[List[str]] = None,
-                 room: MatrixNioRoom = None):
+                 room: MatrixNioRoom = None,
+                 power_level: int = 0):
         super().__init__(an_id, full_name=full_name, emails=emails, client=client)
         self._room = room
+        self._power_level = power_level
 
     @property
     def room(self) -> Optional[MatrixNioRoom]:
         return self._room
 
+    @property
+    def power_level(self) -> int:
+        """
+        Maps to MatrixNioPowerLevels.get(user_id)
+        :return: the power level of the occupant in the room
+        """
+        return self._power_level
 
-class MatrixNioBackend(ErrBot):
-    def __init__(self, config):
-        super().__init__(config)
-        self.has_synced = False
-        self.identity = config.BOT_IDENTITY
-        for key in ('email', 'auth_dict', 'site'):
-            if key not in self.identity:
-                log.fatal(
-                    f"You need to supply the key `{key}` for me to use. `{key}` and its value "
-                    "can be found in your bot's `matrixniorc` config file."
-                )
-                sys.exit(1)
-        # Store the sync token in order to avoid replay of old messages.
-        config = AsyncClientConfig(store_sync_tokens=True)
-        self.client = nio.AsyncClient(
-            self.identity['site'],
-            self.identity['email'],
-            config=config
-        )
 
-    def serve_once(self) -> bool:
-        log.debug("Serve once")
-        return asyncio.get_event_loop().run_until_complete(self._serve_once())
+class MatrixNioPowerLevels(object):
+    """
+    Lookup table of the power level of each user of a room.
+    """
 
-    async def _serve_once(self) -> bool:
-        try:
-            if not self.client.logged_in:
-                log.info("Initializing connection")
-                login_response = await self.client.login_raw(self.identity['auth_dict'])
-                if isinstance(login_response, LoginError):
-                    log.error(f"Failed login result: {login_response}")
-                    raise ValueError(login_response)
-                self.connect_callback()
-                self.bot_identifier = await self.build_identifier(login_response.user_id)
-                self.reset_reconnection_count()
-            if self.has_synced:
-                log.debug("Starting sync")
-                await self.client.sync_forever(30000, full_state=True)
-                log.debug("Sync finished")
-                return False
-            else:
-                log.info("First sync, discarding previous messages")
-                sync_response = await self.client.sync(full_state=True)
-                if isinstance(sync_response, ErrorResponse):
-                    log.exception("Error reading from Matrix Nio updates rooms.")
-                    raise ValueError(sync_response)
-                self.has_synced = True
-                self.client.next_batch = sync_response.next_batch
-                # Only setup callback after first sync in order to avoid processing previous messages
-                self.client.add_event_callback(self.handle_message, nio.RoomMessageText)
-                log.info("End of first sync, now starting normal operation")
-                return False
-        except (KeyboardInterrupt, StopIteration):
-            log.info("Interrupt received, shutting down..")
-            await self.client.logout()
-            log.debug("Triggering disconnect callback.")
-            self.disconnect_callback()
-            return True
+    def __init__(self, users: Optional[Dict[str, int]] = None, users_default: int = 0):
+        self._users = dict(users or {})
+        self._users_default = users_default
 
-    def handle_message(self, room: nio.MatrixRoom, event: nio.Event) -> None:
+    @classmethod
+    def from_power_levels(cls, power_levels: "nio.PowerLevels") -> "MatrixNioPowerLevels":
+        return cls(power_levels.users, power_levels.defaults.users_default)
+
+    def get(self, user_id: str) -> int:
+        return self._users.get(user_id, self._users_default)
+
+    def update(self, power_levels: "nio.PowerLevels") -> None:
         """
-        Handles incoming messages.
+        Applies the content of a new m.room.power_levels event, only touching the users whose level changed
         """
-        log.debug(f"Handle room message\n"
-                  f"Room: {room}\n"
-                  f"Event: {event}")
+        users = power_levels.users
+        for user_id in [user_id for user_id in self._users if user_id not in users]:
+            del self._users[user_id]
+        for user_id, level in users.items():
+            if self._users.get(user_id) != level:
+                self._users[user_id] = level
+        self._users_default = power_levels.defaults.users_default
 
-        if not isinstance(event, nio.RoomMessageText):
-            log.warning("Unhandled message type (not a text message) ignored")
-            return
 
-        message_instance = self.build_message(event.body)
-        message_instance.frm = MatrixNioRoomOccupant(
-            event.sender,
-            full_name=room.user_name(event.sender),
-            emails=[event.sender],
-            client=self.client,
-            room=room.room_id
-        )
-        room_instance = MatrixNioRoom(
-            room.room_id,
-            title=room.name,
-            subject=room.display_name,
-            client=self.client
-        )
-        message_instance.to = room_instance
-        self.callback_message(message_instance)
+def _hash_file(path: str) -> tuple:
+    """
+    :return: (SHA-256 hex digest, size) of the file
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as media_file:
+        for chunk in iter(lambda: media_file.read(MatrixNioMediaCache.CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
 
-    def send_message(self, msg: Message) -> RoomSendResponse:
-        log.debug(f"Sending message {msg}")
-        super().send_message(msg)
-        result = asyncio.run_coroutine_threadsafe(self._send_message(msg), asyncio.get_event_loop())
-        return result
 
-    async def _send_message(self, msg: Message) -> RoomSendResponse:
-        msg_data = {
-            'msgtype': "m.text",
-            'body': msg.body
-        }
-        result = await self.client.room_send(
-            room_id=str(msg.to.room),
-            message_type='m.room.message',
-            content=msg_data
-        )
-        # TODO RoomSendError not trapped properly
-        if isinstance(result, RoomSendResponse):
-            return result
-        else:
-            raise ValueError(f"An exception occurred while trying to send the following message "
-                             f"to {msg.to}: {msg.body}\n{result}")
+class MatrixNioMediaCache(object):
+    """
+    Size bounded on-disk cache of downloaded media. Files are named after their SHA-256 so that
+    identical content reached through several mxc URLs is stored once, and the least recently used
+    ones are evicted beyond `max_size` bytes.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    INDEX = 'index.json'
+
+    def __init__(self, directory: str, max_size: int = 100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        # mxc URL -> content hash, loaded on first use
+        self._urls = {}  # type: Dict[str, str]
+        self._loaded = False
+        # content hash -> size, least recently used first
+        self._files = OrderedDict()  # type: OrderedDict
+        self._downloads = {}  # type: Dict[str, asyncio.Future]
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._files)
+
+    @property
+    def size(self) -> int:
+        self._load()
+        return sum(self._files.values())
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash)
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                # Interrupted download
+                os.remove(path)
+            elif name != self.INDEX:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._files[name] = size
+        self._urls = {url: content_hash
+                      for url, content_hash in _read_json(self._path(self.INDEX), {}).items()
+                      if content_hash in self._files}
+        self._loaded = True
+
+    def _touch(self, content_hash: str) -> str:
+        path = self._path(content_hash)
+        self._files.move_to_end(content_hash)
+        # The modification time keeps the LRU order across restarts
+        os.utime(path)
+        return path
+
+    async def fetch(self, url: str, download: Callable[[str], Awaitable]) -> str:
+        """
+        The path of the cached content of `url`, downloaded to a given path with `download` if needed.
+        Concurrent fetches of the same URL share a single download.
+        """
+        self._load()
+        content_hash = self._urls.get(url)
+        if content_hash is not None:
+            return self._touch(content_hash)
+        return await _in_flight(self._downloads, url, lambda: self._download(url, download))
+
+    async def _download(self, url: str, download: Callable[[str], Awaitable]) -> str:
+        part = self._path(f"{uuid.uuid4().hex}.part")
+        try:
+            await download(part)
+            content_hash, size = await asyncio.get_event_loop().run_in_executor(None, _hash_file, part)
+            if content_hash in self._files:
+                log.debug(f"{url} has the same content as an already cached media")
+                os.remove(part)
+            else:
+                os.replace(part, self._path(content_hash))
+                self._files[content_hash] = size
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        self._urls[url] = content_hash
+        path = self._touch(content_hash)
+        self._evict(content_hash)
+        _write_json(self._path(self.INDEX), self._urls)
+        return path
+
+    def _evict(self, keep: str) -> None:
+        total = sum(self._files.values())
+        for content_hash in list(self._files):
+            if total <= self.max_size:
+                break
+            if content_hash == keep:
+                continue
+            total -= self._files.pop(content_hash)
+            os.remove(self._path(content_hash))
+            self._urls = {url: kept for url, kept in self._urls.items() if kept != content_hash}
+
+
+class MatrixNioAttachment(object):
+    """
+    A file attached to a message (m.image, m.file, m.audio or m.video), downloaded on first use.
+    Available to plugins as `msg.extras['attachment']`.
+
+    Attachments are not commands, so plugins usually get them in `callback_message`, which errbot runs on the
+    event loop thread: there, only `await attachment.fetch()` (from a coroutine scheduled on the loop) is safe.
+    `path()` and `open()` wait for the loop and raise ValueError when called from it.
+    """
+
+    def __init__(self, backend: "MatrixNioBackend", url: str, name: str, mimetype: Optional[str] = None,
+                 size: Optional[int] = None):
+        self._backend = backend
+        self.url = url
+        self.name = name
+        self.mimetype = mimetype
+        self.size = size
+
+    def __repr__(self) -> str:
+        return f"<MatrixNioAttachment {self.name} {self.url}>"
+
+    async def fetch(self) -> str:
+        """
+        Downloads the file, from a coroutine
+        :return: the path of the file in the media cache
+        """
+        return await self._backend.download_media(self.url)
+
+    def path(self) -> str:
+        """
+        Downloads the file, from a plugin thread. Raises ValueError on the event loop thread, use fetch there.
+        :return: the path of the file in the media cache
+        """
+        return self._backend._run_blocking(self.fetch())
+
+    def open(self, mode: str = 'rb'):
+        return open(self.path(), mode)
+
+
+class MatrixNioEditableMessage(object):
+    """
+    A message that is sent once and then updated in place through `m.replace` edits.
+
+    Updates are debounced: only the latest body is sent, at most once per `interval` seconds,
+    so a plugin reporting progress many times per second produces a handful of events.
+    """
+
+    def __init__(self, backend: "MatrixNioBackend", body: str, interval: float, loop: asyncio.AbstractEventLoop):
+        self._backend = backend
+        self._room_id = None  # type: Optional[str]
+        self._body = body
+        self._interval = interval
+        self._loop = loop
+        self._sent = loop.create_future()
+        self._pending_body = None  # type: Optional[str]
+        self._last_edit = 0.0
+        self._flush_handle = None  # type: Optional[asyncio.TimerHandle]
+        self._flush_task = None  # type: Optional[asyncio.Task]
+
+    @property
+    def room_id(self) -> Optional[str]:
+        """
+        :return: the room the message was sent to, None until it has been sent
+        """
+        return self._room_id
+
+    @property
+    def body(self) -> str:
+        """
+        Last body sent to the room
+        :return: the body of the latest edit
+        """
+        return self._body
+
+    async def event_id(self) -> str:
+        """
+        Waits for the original message to be sent
+        :return: the event_id of the original message
+        """
+        return await asyncio.shield(self._sent)
+
+    def update(self, body: str) -> None:
+        """
+        Replaces the content of the message. Safe to call from any thread.
+        """
+        self._loop.call_soon_threadsafe(self._schedule, body)
+
+    async def flush(self) -> None:
+        """
+        Sends the pending edit right away and waits until it has been sent.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+            self._start_flush()
+        while self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+
+    def _set_event_id(self, future: concurrent.futures.Future) -> None:
+        if future.cancelled():
+            self._sent.cancel()
+            return
+        exception = future.exception()
+        if exception is not None:
+            self._sent.set_exception(exception)
+        else:
+            self._room_id = future.result().room_id
+            self._sent.set_result(future.result().event_id)
+
+    @property
+    def _failed(self) -> bool:
+        return self._sent.done() and (self._sent.cancelled() or self._sent.exception() is not None)
+
+    def _schedule(self, body: str) -> None:
+        if self._failed:
+            # The original message was never sent, there is nothing to edit
+            return
+        self._pending_body = body
+        if self._flush_handle is not None or self._flush_task is not None:
+            # An edit is already on its way, it will pick up the latest body
+            return
+        delay = max(0.0, self._last_edit + self._interval - self._loop.time())
+        self._flush_handle = self._loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        self._flush_task = self._loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        try:
+            await asyncio.wait([self._sent])
+            body, room_id = self._pending_body, self._room_id
+            self._pending_body = None
+            if self._failed:
+                # Stops here for good, _schedule ignores the updates of a message that was never sent
+                log.warning("Dropping the edits of a message that could not be sent")
+                return
+            if body is None or room_id is None:
+                return
+            event_id = self._sent.result()
+            self._last_edit = self._loop.time()
+            await self._backend._room_send(room_id, {
+                'msgtype': "m.text",
+                'body': f"* {body}",
+                'm.new_content': {
+                    'msgtype': "m.text",
+                    'body': body
+                },
+                'm.relates_to': {
+                    'rel_type': "m.replace",
+                    'event_id': event_id
+                }
+            })
+            self._body = body
+        finally:
+            self._flush_task = None
+            if self._pending_body is not None:
+                self._schedule(self._pending_body)
+
+
+class MatrixNioMemberDatabase(object):
+    """
+    On-disk store of the members of every room, used by `MatrixNioCompactRoom`.
+
+    It only mirrors the state received through sync, so it is emptied when opened.
+    Members and names are buffered and written in a single transaction by `flush`, as a sync
+    of a large room adds tens of thousands of them at once.
+    """
+    PAGE_SIZE = 500
+    FLUSH_SIZE = 10000
+
+    def __init__(self, path: str):
+        self._lock = threading.RLock()
+        # (room_id, user_id) -> members row, and names rows, not written yet
+        self._pending_members = {}  # type: Dict[tuple, tuple]
+        self._pending_names = []  # type: List[tuple]
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute("PRAGMA synchronous = OFF")
+            self._connection.execute("PRAGMA journal_mode = MEMORY")
+            self._connection.execute("DROP TABLE IF EXISTS members")
+            self._connection.execute("DROP TABLE IF EXISTS names")
+            self._connection.execute(
+                "CREATE TABLE members (room_id TEXT, user_id TEXT, display_name TEXT, avatar_url TEXT, "
+                "power_level INTEGER, invited INTEGER, PRIMARY KEY (room_id, user_id)) WITHOUT ROWID"
+            )
+            self._connection.execute(
+                "CREATE TABLE names (room_id TEXT, name TEXT, user_id TEXT, "
+                "PRIMARY KEY (room_id, name, user_id)) WITHOUT ROWID"
+            )
+
+    def _fetch(self, query: str, *parameters) -> list:
+        with self._lock:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def _execute(self, query: str, *parameters) -> None:
+        with self._lock:
+            self._connection.execute(query, parameters)
+
+    def flush(self) -> None:
+        """
+        Writes the buffered members and names with executemany, in a single transaction
+        """
+        with self._lock:
+            if not self._pending_members and not self._pending_names:
+                return
+            members, self._pending_members = list(self._pending_members.values()), {}
+            names, self._pending_names = self._pending_names, []
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)", members)
+                self._connection.executemany("INSERT OR IGNORE INTO names VALUES (?, ?, ?)", names)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def get_member(self, room_id: str, user_id: str) -> Optional[tuple]:
+        with self._lock:
+            pending = self._pending_members.get((room_id, user_id))
+        if pending is not None:
+            return pending[1:]
+        rows = self._fetch(
+            "SELECT user_id, display_name, avatar_url, power_level, invited FROM members "
+            "WHERE room_id = ? AND user_id = ?", room_id, user_id
+        )
+        return rows[0] if rows else None
+
+    def put_member(self, room_id: str, user: "nio.MatrixUser") -> None:
+        with self._lock:
+            self._pending_members[(room_id, user.user_id)] = (
+                room_id, user.user_id, user.display_name, user.avatar_url, user.power_level, user.invited
+            )
+            if len(self._pending_members) >= self.FLUSH_SIZE:
+                self.flush()
+
+    def delete_member(self, room_id: str, user_id: str) -> None:
+        with self._lock:
+            self._pending_members.pop((room_id, user_id), None)
+            self._execute("DELETE FROM members WHERE room_id = ? AND user_id = ?", room_id, user_id)
+
+    def count_members(self, room_id: str) -> int:
+        self.flush()
+        return self._fetch("SELECT COUNT(*) FROM members WHERE room_id = ?", room_id)[0][0]
+
+    def iter_members(self, room_id: str) -> Iterator[tuple]:
+        """
+        Iterates over the members of a room one page at a time, without holding the whole list in memory
+        """
+        self.flush()
+        last_user_id = ""
+        while True:
+            rows = self._fetch(
+                "SELECT user_id, display_name, avatar_url, power_level, invited FROM members "
+                "WHERE room_id = ? AND user_id > ? ORDER BY user_id LIMIT ?", room_id, last_user_id, self.PAGE_SIZE
+            )
+            yield from rows
+            if len(rows) < self.PAGE_SIZE:
+                return
+            last_user_id = rows[-1][0]
+
+    def get_name(self, room_id: str, name: str) -> List[str]:
+        self.flush()
+        return [row[0] for row in self._fetch(
+            "SELECT user_id FROM names WHERE room_id = ? AND name = ?", room_id, name
+        )]
+
+    def add_name(self, room_id: str, name: str, user_id: str) -> None:
+        with self._lock:
+            self._pending_names.append((room_id, name, user_id))
+            if len(self._pending_names) >= self.FLUSH_SIZE:
+                self.flush()
+
+    def remove_name(self, room_id: str, name: str, user_id: str) -> bool:
+        with self._lock:
+            self.flush()
+            cursor = self._connection.execute(
+                "DELETE FROM names WHERE room_id = ? AND name = ? AND user_id = ?", (room_id, name, user_id)
+            )
+            return cursor.rowcount > 0
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+
+class MatrixNioMemberStore(MutableMapping):
+    """
+    Replaces the `MatrixRoom.users` dict: members live in the database and only
+    the `cache_size` most recently used ones are kept in memory.
+    """
+
+    def __init__(self, database: MatrixNioMemberDatabase, room_id: str, cache_size: int = 256):
+        self._database = database
+        self._room_id = room_id
+        self._cache_size = cache_size
+        self._cache = OrderedDict()  # type: OrderedDict
+
+    def _cached(self, user: "nio.MatrixUser") -> "nio.MatrixUser":
+        self._cache[user.user_id] = user
+        self._cache.move_to_end(user.user_id)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return user
+
+    def _from_row(self, row: tuple) -> "nio.MatrixUser":
+        user_id, display_name, avatar_url, power_level, invited = row
+        return _nio_classes['MatrixNioStoredUser'](self, user_id, display_name, avatar_url, power_level,
+                                                   bool(invited))
+
+    def save(self, user: "nio.MatrixUser") -> None:
+        self._database.put_member(self._room_id, user)
+
+    def __getitem__(self, user_id: str) -> "nio.MatrixUser":
+        if user_id in self._cache:
+            self._cache.move_to_end(user_id)
+            return self._cache[user_id]
+        row = self._database.get_member(self._room_id, user_id)
+        if row is None:
+            raise KeyError(user_id)
+        return self._cached(self._from_row(row))
+
+    def __setitem__(self, user_id: str, user: "nio.MatrixUser") -> None:
+        self.save(user)
+        self._cached(self._from_row((user_id, user.display_name, user.avatar_url, user.power_level, user.invited)))
+
+    def __delitem__(self, user_id: str) -> None:
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._cache.pop(user_id, None)
+        self._database.delete_member(self._room_id, user_id)
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._cache or self._database.get_member(self._room_id, str(user_id)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self._database.iter_members(self._room_id))
+
+    def __len__(self) -> int:
+        return self._database.count_members(self._room_id)
+
+    def values(self) -> Iterator["nio.MatrixUser"]:  # type: ignore
+        # Members are not cached while iterating, listing a huge room must not evict the useful ones
+        return (self._cache.get(row[0]) or self._from_row(row) for row in self._database.iter_members(self._room_id))
+
+
+class MatrixNioNameList(object):
+    """
+    The user ids sharing a display name, as expected by `MatrixRoom.names`.
+    """
+
+    def __init__(self, database: MatrixNioMemberDatabase, room_id: str, name: str):
+        self._database = database
+        self._room_id = room_id
+        self._name = name
+
+    def append(self, user_id: str) -> None:
+        self._database.add_name(self._room_id, self._name, user_id)
+
+    def remove(self, user_id: str) -> None:
+        if not self._database.remove_name(self._room_id, self._name, user_id):
+            raise ValueError(f"{user_id} is not named {self._name}")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._database.get_name(self._room_id, self._name))
+
+    def __len__(self) -> int:
+        return len(self._database.get_name(self._room_id, self._name))
+
+
+class MatrixNioNameIndex(object):
+    """
+    Replaces the `MatrixRoom.names` defaultdict with lookups in the member database.
+    """
+
+    def __init__(self, database: MatrixNioMemberDatabase, room_id: str):
+        self._database = database
+        self._room_id = room_id
+
+    def __getitem__(self, name: str) -> MatrixNioNameList:
+        return MatrixNioNameList(self._database, self._room_id, name)
+
+
+def _define_nio_classes() -> Dict[str, type]:
+    """
+    The classes extending nio, only defined once nio is loaded
+    """
+    class MatrixNioStoredUser(nio.MatrixUser):
+        """
+        A MatrixUser writing its changes back to the member database.
+        """
+        STORED_ATTRIBUTES = ('display_name', 'avatar_url', 'power_level', 'invited')
+
+        def __init__(self, members: "MatrixNioMemberStore", *args, **kwargs):
+            object.__setattr__(self, '_members', None)
+            super().__init__(*args, **kwargs)
+            object.__setattr__(self, '_members', members)
+
+        def __setattr__(self, name: str, value: Any) -> None:
+            super().__setattr__(name, value)
+            if self._members is not None and name in self.STORED_ATTRIBUTES:
+                self._members.save(self)
+
+    class MatrixNioCompactRoom(nio.MatrixRoom):
+        """
+        A MatrixRoom keeping its members in a `MatrixNioMemberDatabase` instead of memory.
+        """
+
+        def __init__(self, room_id: str, own_user_id: str, encrypted: bool = False, *,
+                     database: MatrixNioMemberDatabase, cache_size: int = 256):
+            super().__init__(room_id, own_user_id, encrypted)
+            self.users = MatrixNioMemberStore(database, room_id, cache_size)
+            self.names = MatrixNioNameIndex(database, room_id)
+
+    class MatrixNioClient(nio.AsyncClient):
+        """
+        AsyncClient decoding response bodies with the fastest JSON decoder available.
+        Bodies larger than `json_thread_threshold` bytes are decoded in a worker thread
+        so that big sync responses do not stall the event loop.
+
+        When a `member_database` is given, joined rooms are created as `MatrixNioCompactRoom`.
+
+        Concurrent identical read requests (profiles, joined rooms, room state) share a single HTTP request.
+        """
+
+        def __init__(self, *args, json_thread_threshold: Optional[int] = None,
+                     member_database: Optional[MatrixNioMemberDatabase] = None, member_cache_size: int = 256, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.json_thread_threshold = json_thread_threshold
+            self.member_database = member_database
+            self.member_cache_size = member_cache_size
+            self.recorder = None  # type: Optional[MatrixNioRecorder]
+            self.profiler = MatrixNioProfiler(enabled=False)
+            self._requests_in_flight = {}  # type: Dict[tuple, asyncio.Future]
+            self.adaptive_timeout = None  # type: Optional[MatrixNioSyncTimeout]
+
+        # get_profile is coalesced by the backend, along with the identifier it builds
+        get_displayname = _single_flight(nio.AsyncClient.get_displayname)
+        get_avatar = _single_flight(nio.AsyncClient.get_avatar)
+        joined_rooms = _single_flight(nio.AsyncClient.joined_rooms)
+        joined_members = _single_flight(nio.AsyncClient.joined_members)
+        room_get_state = _single_flight(nio.AsyncClient.room_get_state)
+        room_get_state_event = _single_flight(nio.AsyncClient.room_get_state_event)
+        room_resolve_alias = _single_flight(nio.AsyncClient.room_resolve_alias)
+
+        async def send(self, *args, **kwargs):
+            with self.profiler.span('network'):
+                return await super().send(*args, **kwargs)
+
+        async def sync(self, timeout: Optional[int] = 0, *args, **kwargs):
+            # The first sync of sync_forever has no timeout, and stays so
+            if self.adaptive_timeout is not None and timeout:
+                timeout = self.adaptive_timeout.timeout
+            response = await super().sync(timeout, *args, **kwargs)
+            if self.adaptive_timeout is not None and isinstance(response, nio.SyncResponse):
+                self.adaptive_timeout.update(
+                    any(room.timeline.events for room in response.rooms.join.values()) or bool(response.rooms.invite)
+                )
+            return response
+
+        async def receive_response(self, response) -> None:
+            # Room state update, including the event callbacks
+            with self.profiler.span('state'):
+                await super().receive_response(response)
+            if self.member_database is not None:
+                # The members added by the update are written from a worker thread
+                await asyncio.get_event_loop().run_in_executor(None, self.member_database.flush)
+
+        def _handle_joined_state(self, room_id: str, join_info, encrypted_rooms: set) -> None:
+            if self.member_database is not None and room_id not in self.rooms:
+                self.rooms[room_id] = MatrixNioCompactRoom(
+                    room_id,
+                    self.user_id,
+                    room_id in self.encrypted_rooms,
+                    database=self.member_database,
+                    cache_size=self.member_cache_size
+                )
+            super()._handle_joined_state(room_id, join_info, encrypted_rooms)
+
+        async def set_direct_rooms(self, direct_rooms: Dict[str, List[str]]):
+            """
+            Replaces the m.direct account data of the user
+            """
+            path = nio.Api._build_path(
+                ["user", self.user_id, "account_data", "m.direct"],
+                {"access_token": self.access_token}
+            )
+            return await self._send(nio.responses.EmptyResponse, "PUT", path, nio.Api.to_json(direct_rooms))
+
+        async def parse_body(self, transport_response) -> dict:
+            body = await transport_response.read()
+            try:
+                with self.profiler.span('parse'):
+                    if self.json_thread_threshold is not None and len(body) > self.json_thread_threshold:
+                        parsed = await asyncio.get_event_loop().run_in_executor(None, json_loads, body)
+                    else:
+                        parsed = json_loads(body)
+            except ValueError:
+                return {}
+            if self.recorder is not None and transport_response.url.path.endswith("/sync"):
+                self.recorder.record('sync', response=parsed)
+            return parsed
+
+    return {
+        'MatrixNioStoredUser': MatrixNioStoredUser,
+        'MatrixNioCompactRoom': MatrixNioCompactRoom,
+        'MatrixNioClient': MatrixNioClient
+    }
+
+
+class MatrixNioBackend(ErrBot):
+    def __init__(self, config):
+        self._client = None
+        super().__init__(config)
+        self.has_synced = False
+        self.identity = config.BOT_IDENTITY
+        for key in ('email', 'auth_dict', 'site'):
+            if key not in self.identity:
+                log.fatal(
+                    f"You need to supply the key `{key}` for me to use. `{key}` and its value "
+                    "can be found in your bot's `matrixniorc` config file."
+                )
+                sys.exit(1)
+        # Minimum delay between two edits of the same message, in seconds
+        self.edit_interval = getattr(self.bot_config, 'MATRIX_NIO_EDIT_INTERVAL', 1000) / 1000
+        # Typing notifications while commands are processed, refreshed at most once per timeout per room
+        self.typing_notifications = getattr(self.bot_config, 'MATRIX_NIO_TYPING_NOTIFICATIONS', False)
+        self.typing_timeout = getattr(self.bot_config, 'MATRIX_NIO_TYPING_TIMEOUT', 30000)
+        self._typing_refreshed = {}  # type: Dict[str, float]
+        # Presence requested by errbot, only the latest one is sent
+        self._presence_wanted = None  # type: Optional[tuple]
+        self._presence_sent = None  # type: Optional[tuple]
+        self._presence_task = None  # type: Optional[asyncio.Task]
+        # Latest processed event per room, acknowledged in batches every MATRIX_NIO_READ_MARKERS_INTERVAL ms
+        self.read_markers_interval = getattr(self.bot_config, 'MATRIX_NIO_READ_MARKERS_INTERVAL', 5000)
+        self._read_markers = {}  # type: Dict[str, str]
+        self._background_tasks = []  # type: List[asyncio.Task]
+        # Dispatch messages to plugins in a dedicated thread, fed through a bounded queue by the sync loop
+        self.pipeline = getattr(self.bot_config, 'MATRIX_NIO_PIPELINE', False)
+        self.pipeline_queue_size = getattr(self.bot_config, 'MATRIX_NIO_PIPELINE_QUEUE_SIZE', 100)
+        self._pending_messages = None  # type: Optional[asyncio.Queue]
+        # A single thread keeps messages in order
+        self._dispatch_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="matrix-nio-dispatch")
+        # Event loop implementation, 'asyncio' or 'uvloop'
+        self.event_loop = getattr(self.bot_config, 'MATRIX_NIO_EVENT_LOOP', 'asyncio')
+        self.loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._loop_thread = None  # type: Optional[threading.Thread]
+        self.power_levels = {}  # type: Dict[str, MatrixNioPowerLevels]
+        self.aliases = MatrixNioAliasCache(
+            getattr(self.bot_config, 'MATRIX_NIO_ALIAS_CACHE_SIZE', 1024),
+            getattr(self.bot_config, 'MATRIX_NIO_ALIAS_CACHE_TTL', 3600)
+        )
+        self.alias_concurrency = getattr(self.bot_config, 'MATRIX_NIO_ALIAS_CONCURRENCY', 10)
+        # user_id -> MatrixNioPerson built from the user's profile
+        self.identifiers = MatrixNioCache(
+            getattr(self.bot_config, 'MATRIX_NIO_IDENTIFIER_CACHE_SIZE', 1024),
+            getattr(self.bot_config, 'MATRIX_NIO_IDENTIFIER_CACHE_TTL', 3600)
+        )
+        self.profile_concurrency = getattr(self.bot_config, 'MATRIX_NIO_PROFILE_CONCURRENCY', 10)
+        # Long-poll timeout of the syncs in ms, shortened while messages keep coming with MATRIX_NIO_SYNC_ADAPTIVE
+        self.sync_timeout = getattr(self.bot_config, 'MATRIX_NIO_SYNC_TIMEOUT', 30000)
+        self.sync_adaptive = getattr(self.bot_config, 'MATRIX_NIO_SYNC_ADAPTIVE', False)
+        self.sync_min_timeout = getattr(self.bot_config, 'MATRIX_NIO_SYNC_MIN_TIMEOUT', 1000)
+        # Presence set by the syncs, 'offline' keeps them from making the bot appear online
+        self.sync_presence = getattr(self.bot_config, 'MATRIX_NIO_SYNC_PRESENCE', None)
+        # Files, images, audio and video messages are dispatched with their attachment in msg.extras
+        self.attachments = getattr(self.bot_config, 'MATRIX_NIO_ATTACHMENTS', False)
+        self._media = None  # type: Optional[MatrixNioMediaCache]
+        self._profile_requests = {}  # type: Dict[str, asyncio.Future]
+        # Content of the m.direct account data: user_id -> DM room ids, and the latest DM room of each user
+        self._direct_rooms_content = {}  # type: Dict[str, List[str]]
+        self.direct_rooms = {}  # type: Dict[str, str]
+        self._direct_room_creations = {}  # type: Dict[str, asyncio.Future]
+        self.accepting_messages = True
+        self._pending_sends = set()  # type: set
+        # Messages sent by plugins from other threads, not started yet
+        self._scheduled_sends = set()  # type: set
+        self.shutdown_timeout = getattr(self.bot_config, 'MATRIX_NIO_SHUTDOWN_TIMEOUT', 10)
+        self.logout_on_shutdown = getattr(self.bot_config, 'MATRIX_NIO_LOGOUT_ON_SHUTDOWN', False)
+        # Log of the sync responses and sent messages, to be replayed offline with `replay`
+        self.record_path = getattr(self.bot_config, 'MATRIX_NIO_RECORD', None)
+        self.recorder = None  # type: Optional[MatrixNioRecorder]
+        # Time spent per stage, and the admin command starting cProfile sessions
+        self.profiler = MatrixNioProfiler(getattr(self.bot_config, 'MATRIX_NIO_PROFILING', False))
+        self.profiling = False
+        # Lag of the event loop, and stack traces of what blocks it for more than MATRIX_NIO_LOOP_LAG_THRESHOLD ms
+        self.watchdog = None  # type: Optional[MatrixNioLoopWatchdog]
+        if getattr(self.bot_config, 'MATRIX_NIO_LOOP_WATCHDOG', False):
+            self.watchdog = MatrixNioLoopWatchdog(
+                getattr(self.bot_config, 'MATRIX_NIO_LOOP_LAG_INTERVAL', 100) / 1000,
+                getattr(self.bot_config, 'MATRIX_NIO_LOOP_LAG_THRESHOLD', 500) / 1000
+            )
+        if self.profiler.enabled or self.watchdog is not None:
+            self.inject_commands_from(MatrixNioCommands(self))
+        # Multi-process mode: a leader owns the Matrix connection, workers run the plugins
+        self.role = getattr(self.bot_config, 'MATRIX_NIO_ROLE', None)
+        self.leader_socket = getattr(self.bot_config, 'MATRIX_NIO_LEADER_SOCKET', None)
+        if self.role and not self.leader_socket:
+            self.leader_socket = self._data_path('matrix_nio.sock')
+        self._workers = []  # type: List[asyncio.StreamWriter]
+        self._leader = None  # type: Optional[asyncio.StreamWriter]
+        self._leader_requests = {}  # type: Dict[int, asyncio.Future]
+        self._leader_request_id = 0
+        # Outbound rate limit in messages per second, shared fairly between rooms
+        self.send_scheduler = None  # type: Optional[MatrixNioSendScheduler]
+        send_rate = getattr(self.bot_config, 'MATRIX_NIO_SEND_RATE', None)
+        if send_rate:
+            self.send_scheduler = MatrixNioSendScheduler(
+                send_rate,
+                getattr(self.bot_config, 'MATRIX_NIO_SEND_BURST', 10),
+                getattr(self.bot_config, 'MATRIX_NIO_SEND_CONCURRENCY', 10)
+            )
+        # Sends in flight at once during a broadcast, and the time after which the unsent ones are given up
+        self.broadcast_concurrency = getattr(self.bot_config, 'MATRIX_NIO_BROADCAST_CONCURRENCY', 50)
+        self.broadcast_timeout = getattr(self.bot_config, 'MATRIX_NIO_BROADCAST_TIMEOUT', None)
+        # Invites accepted automatically, from BOT_ADMINS, MATRIX_NIO_INVITE_USERS or users of MATRIX_NIO_INVITE_SERVERS
+        self.auto_accept_invites = getattr(self.bot_config, 'MATRIX_NIO_AUTO_ACCEPT_INVITES', False)
+        self.invite_users = set(getattr(self.bot_config, 'MATRIX_NIO_INVITE_USERS', ()))
+        self.invite_servers = set(getattr(self.bot_config, 'MATRIX_NIO_INVITE_SERVERS', ()))
+        self.invite_concurrency = getattr(self.bot_config, 'MATRIX_NIO_INVITE_CONCURRENCY', 10)
+        # room_id -> inviter, waiting to be accepted
+        self._invites = {}  # type: Dict[str, str]
+        self._invite_batch = None  # type: Optional[asyncio.Task]
+        self._room_warm_ups = set()  # type: set
+        # Guards against processing the same event twice when sync batches are replayed
+        self.deduplicator = MatrixNioEventDeduplicator(
+            getattr(self.bot_config, 'MATRIX_NIO_DEDUP_SIZE', 10000),
+            getattr(self.bot_config, 'MATRIX_NIO_DEDUP_WINDOW', 3600)
+        )
+        # Catching up relies on it to skip the messages already processed before a crash.
+        # Workers receive their messages from the leader, which owns the state saved in BOT_DATA_DIR
+        self.persist_deduplicator = self.role != 'worker' and (
+            getattr(self.bot_config, 'MATRIX_NIO_DEDUP_PERSIST', False) or
+            getattr(self.bot_config, 'MATRIX_NIO_CATCH_UP', False)
+        )
+        if self.persist_deduplicator:
+            self.deduplicator.load(self._data_path('matrix_nio_events.json'))
+        # Process the messages received while the bot was down instead of discarding them
+        self.catch_up = getattr(self.bot_config, 'MATRIX_NIO_CATCH_UP', False)
+        self.catch_up_max_age = getattr(self.bot_config, 'MATRIX_NIO_CATCH_UP_MAX_AGE', 3600)
+        self.catch_up_batch_size = getattr(self.bot_config, 'MATRIX_NIO_CATCH_UP_BATCH_SIZE', 10)
+        self.catch_up_batch_delay = getattr(self.bot_config, 'MATRIX_NIO_CATCH_UP_BATCH_DELAY', 1000) / 1000
+        # Token of the latest sync whose messages were accepted, the one saved for catching up
+        self._sync_token = None  # type: Optional[str]
+
+    @property
+    def client(self) -> "nio.AsyncClient":
+        """
+        The Matrix client, created (and nio loaded) on first use
+        :return: MatrixNioClient
+        """
+        if self._client is None:
+            self._client = self._create_client()
+        return self._client
+
+    @client.setter
+    def client(self, client: "nio.AsyncClient") -> None:
+        self._client = client
+
+    def _create_client(self) -> "nio.AsyncClient":
+        _load_nio()
+        # Keep room members on disk rather than in memory for huge rooms.
+        # The store and the traffic log in BOT_DATA_DIR belong to the leader, workers do not sync
+        member_database = None
+        if getattr(self.bot_config, 'MATRIX_NIO_COMPACT_ROOMS', False) and self.role != 'worker':
+            member_database = MatrixNioMemberDatabase(self._data_path('matrix_nio_members.sqlite'))
+        # Store the sync token in order to avoid replay of old messages.
+        config = nio.AsyncClientConfig(store_sync_tokens=True)
+        client = _nio_classes['MatrixNioClient'](
+            self.identity['site'],
+            self.identity['email'],
+            config=config,
+            json_thread_threshold=getattr(self.bot_config, 'MATRIX_NIO_JSON_THREAD_THRESHOLD', 1024 * 1024),
+            member_database=member_database,
+            member_cache_size=getattr(self.bot_config, 'MATRIX_NIO_MEMBER_CACHE_SIZE', 256)
+        )
+        if self.record_path and self.role != 'worker':
+            log.info(f"Recording the Matrix traffic to {self.record_path}")
+            self.recorder = MatrixNioRecorder(self._data_path(self.record_path))
+            client.recorder = self.recorder
+        client.profiler = self.profiler
+        if self.sync_adaptive:
+            client.adaptive_timeout = MatrixNioSyncTimeout(self.sync_min_timeout, self.sync_timeout)
+        return client
+
+    def serve_once(self) -> bool:
+        log.debug("Serve once")
+        _load_nio()
+        loop = self._get_loop()
+        asyncio.set_event_loop(loop)
+        self._loop_thread = threading.current_thread()
+        try:
+            return loop.run_until_complete(self._serve_once())
+        except KeyboardInterrupt:
+            log.info("Interrupt received, shutting down..")
+            loop.run_until_complete(self._shutdown())
+            return True
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        The loop running the backend, usable from plugin threads.
+        Created on first use and kept across reconnections, the client session and background tasks are bound to it.
+        """
+        if self.loop is None:
+            self.loop = _new_event_loop(self.event_loop)
+        return self.loop
+
+    async def _serve_once(self) -> bool:
+        if self.role == 'worker':
+            return await self._serve_worker()
+        try:
+            if not self.client.logged_in:
+                log.info("Initializing connection")
+                with self.profiler.span('login'):
+                    login_response = await self.client.login_raw(self.identity['auth_dict'])
+                if isinstance(login_response, nio.LoginError):
+                    log.error(f"Failed login result: {login_response}")
+                    raise ValueError(login_response)
+                self.connect_callback()
+                # The admins are resolved along with the bot itself, in a single round trip
+                await self.prefetch_identifiers([login_response.user_id] + [
+                    admin for admin in getattr(self.bot_config, 'BOT_ADMINS', ()) if admin.startswith('@')
+                ])
+                self.bot_identifier = await self.build_identifier(login_response.user_id)
+                self.reset_reconnection_count()
+            if self.has_synced:
+                self._start_background_tasks()
+                log.debug("Starting sync")
+                try:
+                    await self.client.sync_forever(self.sync_timeout, **self._sync_arguments())
+                except Exception:
+                    await self._stop_background_tasks()
+                    raise
+                await self._stop_background_tasks()
+                log.debug("Sync finished")
+                return False
+            else:
+                sync_arguments = self._sync_arguments()
+                since = self._load_sync_token() if self.catch_up else None
+                if since:
+                    log.info(f"First sync, catching up on messages since {since}")
+                    sync_arguments['since'] = since
+                else:
+                    log.info("First sync, discarding previous messages")
+                self._add_first_sync_callbacks()
+                with self.profiler.span('sync'):
+                    sync_response = await self.client.sync(**sync_arguments)
+                if isinstance(sync_response, nio.ErrorResponse):
+                    log.exception("Error reading from Matrix Nio updates rooms.")
+                    raise ValueError(sync_response)
+                self.has_synced = True
+                self.client.next_batch = sync_response.next_batch
+                # Only setup callback after first sync in order to avoid processing previous messages
+                self._add_callbacks()
+                for matrix_room in self.client.rooms.values():
+                    if matrix_room.canonical_alias:
+                        self.aliases.put(matrix_room.canonical_alias, matrix_room.room_id)
+                if self.auto_accept_invites:
+                    # Invites received while the bot was offline
+                    for invited_room in list(self.client.invited_rooms.values()):
+                        if invited_room.inviter is not None:
+                            self._queue_invite(invited_room.room_id, invited_room.inviter)
+                # Resolve the rooms errbot will join all at once rather than one at a time
+                await self.resolve_room_aliases(
+                    [room for room in getattr(self.bot_config, 'CHATROOM_PRESENCE', ()) if room.startswith('#')]
+                )
+                if since:
+                    await self._catch_up(sync_response, since)
+                self._sync_token = sync_response.next_batch
+                log.info("End of first sync, now starting normal operation")
+                return False
+        except (KeyboardInterrupt, StopIteration):
+            log.info("Interrupt received, shutting down..")
+            await self._shutdown()
+            return True
+
+    def _sync_arguments(self) -> dict:
+        sync_arguments = {'full_state': True}
+        if self.sync_presence:
+            sync_arguments['set_presence'] = self.sync_presence
+        return sync_arguments
+
+    def _add_first_sync_callbacks(self) -> None:
+        # m.direct is only sent again when it changes, so it is indexed from the first sync on
+        self.client.add_global_account_data_callback(self.handle_account_data, nio.UnknownAccountDataEvent)
+
+    def _add_callbacks(self) -> None:
+        self.client.add_event_callback(self.handle_power_levels, nio.PowerLevelsEvent)
+        self.client.add_event_callback(self.handle_canonical_alias, nio.RoomAliasEvent)
+        self.client.add_response_callback(self.handle_sync, nio.SyncResponse)
+        if self.auto_accept_invites:
+            self.client.add_event_callback(self.handle_invite, nio.InviteMemberEvent)
+        if self.pipeline:
+            self.client.add_event_callback(self._enqueue_message, self._message_types())
+        else:
+            self.client.add_event_callback(self.handle_message, self._message_types())
+        if self.role == 'leader':
+            self.client.add_event_callback(self._wait_for_workers, self._message_types())
+
+    def _message_types(self) -> tuple:
+        return (nio.RoomMessageText, nio.RoomMessageMedia) if self.attachments else (nio.RoomMessageText,)
+
+    async def replay(self, path: str, speed: Optional[float] = 1.0) -> List[dict]:
+        """
+        Feeds a log recorded with MATRIX_NIO_RECORD back through the backend, without network.
+        As live, the first sync response only loads the state of the rooms.
+        :param path: the recorded log
+        :param speed: 1.0 replays at the recorded pace, 2.0 twice as fast, None as fast as possible
+        :return: the messages sent while replaying, as {'room_id': ..., 'content': ...}
+        """
+        sent = []  # type: List[dict]
+
+        async def room_send(room_id: str, message_type: str, content: dict, *args, **kwargs) -> "nio.RoomSendResponse":
+            sent.append({'room_id': room_id, 'content': content})
+            return nio.RoomSendResponse.from_dict({'event_id': f"$replay{len(sent)}"}, room_id)
+
+        live_room_send = self.client.room_send
+        self.client.room_send = room_send
+        self.loop = asyncio.get_event_loop()
+        dispatcher = None
+        if self.pipeline:
+            dispatcher = asyncio.ensure_future(self._dispatch_forever())
+        previous = None
+        if not self.has_synced:
+            self._add_first_sync_callbacks()
+        try:
+            for record in MatrixNioRecorder.read(path):
+                if record['type'] != 'sync':
+                    continue
+                if speed and previous is not None:
+                    await asyncio.sleep(max(0.0, record['time'] - previous) / speed)
+                previous = record['time']
+                response = nio.SyncResponse.from_dict(record['response'])
+                if isinstance(response, nio.ErrorResponse):
+                    log.warning(f"Recorded sync error skipped: {response}")
+                    continue
+                await self.client.receive_response(response)
+                if not self.has_synced:
+                    self.has_synced = True
+                    self._add_callbacks()
+            if dispatcher is not None:
+                await self._dispatch_queue.join()
+            await self._wait_for_sends()
+        finally:
+            if dispatcher is not None:
+                dispatcher.cancel()
+            self.client.room_send = live_room_send
+        return sent
+
+    async def _wait_for_sends(self, timeout: Optional[float] = None) -> None:
+        sends = set(self._pending_sends) | {asyncio.wrap_future(send) for send in set(self._scheduled_sends)}
+        if sends:
+            await asyncio.wait(sends, timeout=timeout)
+
+    async def _shutdown(self) -> None:
+        """
+        Stops receiving messages, lets the messages being processed and sent finish within
+        MATRIX_NIO_SHUTDOWN_TIMEOUT seconds, then saves the state and closes the connection.
+        The device is only logged out if MATRIX_NIO_LOGOUT_ON_SHUTDOWN is set.
+        """
+        self.accepting_messages = False
+        # Missing from older matrix-nio releases, the sync loop is then only stopped by the interruption
+        stop_sync_forever = getattr(self.client, 'stop_sync_forever', None)
+        if stop_sync_forever is not None:
+            stop_sync_forever()
+        deadline = time.monotonic() + self.shutdown_timeout
+        if self.pipeline and self._dispatch_queue.qsize():
+            log.info(f"Waiting for {self._dispatch_queue.qsize()} messages to be dispatched")
+            drained = asyncio.ensure_future(self._dispatch_queue.join())
+            await asyncio.wait([drained], timeout=max(0.0, deadline - time.monotonic()))
+            drained.cancel()
+        if self._pending_sends or self._scheduled_sends:
+            log.info(f"Waiting for {len(self._pending_sends) + len(self._scheduled_sends)} messages to be sent")
+            await self._wait_for_sends(max(0.0, deadline - time.monotonic()))
+        await self._stop_background_tasks()
+        if self.logout_on_shutdown:
+            await self.client.logout()
+        await self.client.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        log.debug("Triggering disconnect callback.")
+        self.disconnect_callback()
+
+    def handle_message(self, room: "nio.MatrixRoom", event: "nio.Event") -> None:
+        """
+        Handles incoming messages.
+        """
+        with self.profiler.span('callback'):
+            self._handle_message(room, event)
+
+    def _handle_message(self, room: "nio.MatrixRoom", event: "nio.Event") -> None:
+        log.debug(f"Handle room message\n"
+                  f"Room: {room}\n"
+                  f"Event: {event}")
+
+        # With the pipeline, messages already queued are still dispatched while shutting down
+        if not self.accepting_messages and not self.pipeline:
+            log.debug(f"Shutting down, event {event.event_id} ignored")
+            return
+        if self.deduplicator.seen(event.event_id):
+            log.debug(f"Event {event.event_id} already processed, ignored")
+            return
+        self._read_markers[room.room_id] = event.event_id
+
+        attachment = None
+        if self.attachments and isinstance(event, nio.RoomMessageMedia):
+            info = event.source.get('content', {}).get('info') or {}
+            attachment = MatrixNioAttachment(self, event.url, event.body, info.get('mimetype'), info.get('size'))
+        elif not isinstance(event, nio.RoomMessageText):
+            log.warning("Unhandled message type (not a text message) ignored")
+            return
+
+        if self.profiler.enabled:
+            # From the homeserver receiving the message to its dispatch to the plugins
+            self.profiler.add('delivery', max(0.0, time.time() - event.server_timestamp / 1000))
+        message_instance = self.build_message(event.body)
+        if attachment is not None:
+            message_instance.extras['attachment'] = attachment
+        message_instance.frm = MatrixNioRoomOccupant(
+            event.sender,
+            full_name=room.user_name(event.sender),
+            emails=[event.sender],
+            client=self.client,
+            room=room.room_id,
+            power_level=self.room_power_levels(room).get(event.sender)
+        )
+        room_instance = MatrixNioRoom(
+            room.room_id,
+            title=room.name,
+            subject=room.display_name,
+            client=self.client,
+            backend=self
+        )
+        message_instance.to = room_instance
+        if self.typing_notifications and self._is_command(message_instance):
+            self._start_typing(room.room_id)
+        if self._workers:
+            self._get_loop().call_soon_threadsafe(self._forward_to_worker, {
+                'type': "message",
+                'room_id': room.room_id,
+                'room_name': room.name,
+                'room_display_name': room.display_name,
+                'sender': event.sender,
+                'sender_name': message_instance.frm.fullname,
+                'power_level': message_instance.frm.power_level,
+                'body': event.body
+            })
+        else:
+            with self.profiler.span('dispatch'):
+                self.callback_message(message_instance)
+
+    def _start_background_tasks(self) -> None:
+        if self._background_tasks:
+            return
+        if self.read_markers_interval:
+            self._background_tasks.append(asyncio.ensure_future(self._send_read_markers_forever()))
+        self._background_tasks.append(asyncio.ensure_future(self._save_state_forever()))
+        if self.pipeline:
+            self._background_tasks.append(asyncio.ensure_future(self._dispatch_forever()))
+        if self.role == 'leader':
+            self._background_tasks.append(asyncio.ensure_future(self._serve_workers_forever()))
+        if self.watchdog is not None:
+            self._background_tasks.append(asyncio.ensure_future(self.watchdog.run()))
+
+    async def _serve_workers_forever(self) -> None:
+        """
+        Accepts the connections of worker processes on MATRIX_NIO_LEADER_SOCKET
+        """
+        if os.path.exists(self.leader_socket):
+            os.unlink(self.leader_socket)
+        server = await asyncio.start_unix_server(self._handle_worker, self.leader_socket, limit=IPC_LINE_LIMIT)
+        log.info(f"Waiting for workers on {self.leader_socket}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            for writer in self._workers:
+                writer.close()
+            self._workers = []
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        log.info("Worker connected")
+        _write_line(writer, {
+            'type': "hello",
+            'user_id': self.bot_identifier.id,
+            'full_name': self.bot_identifier.fullname
+        })
+        self._workers.append(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                asyncio.ensure_future(self._handle_worker_request(json_loads(line), writer))
+        finally:
+            log.info("Worker disconnected")
+            if writer in self._workers:
+                self._workers.remove(writer)
+            writer.close()
+
+    async def _handle_worker_request(self, request: dict, writer: asyncio.StreamWriter) -> None:
+        if request['type'] == "presence":
+            self.change_presence(request['status'], request['message'])
+            return
+        try:
+            if request['type'] == "broadcast":
+                reply = await self._broadcast_for_worker(request)
+            else:
+                reply = await self._send_for_worker(request)
+        except Exception as error:
+            log.exception(f"Error while handling the request of a worker {request}")
+            reply = {'type': "error", 'error': str(error)}
+        reply['id'] = request['id']
+        # StreamWriter.is_closing is missing from Python 3.6
+        if not writer.transport.is_closing():
+            _write_line(writer, reply)
+
+    async def _send_for_worker(self, request: dict) -> dict:
+        room_id = request.get('room_id') or await self.get_direct_room(request['user_id'])
+        result = await self._room_send(room_id, request['content'], priority=request.get('priority', False))
+        # The typing notification was started by the leader when forwarding the message
+        await self._stop_typing(room_id)
+        return {'type': "sent", 'room_id': result.room_id, 'event_id': result.event_id}
+
+    async def _broadcast_for_worker(self, request: dict) -> dict:
+        targets = [
+            target if isinstance(target, str) else target.get('room_id') or MatrixNioIdentifier(target['user_id'])
+            for target in request['targets']
+        ]
+        outcomes = await self.broadcast(request['body'], targets, request['timeout'])
+        return {'type': "broadcast", 'outcomes': {
+            key: {'error': str(outcome)} if isinstance(outcome, BaseException)
+            else {'room_id': outcome.room_id, 'event_id': outcome.event_id}
+            for key, outcome in outcomes.items()
+        }}
+
+    def _forward_to_worker(self, message: dict) -> None:
+        if not self._workers:
+            log.warning(f"No worker left to process {message}")
+            return
+        # Messages of a room always go to the same worker, in order
+        worker = self._workers[zlib.crc32(message['room_id'].encode()) % len(self._workers)]
+        _write_line(worker, message)
+
+    async def _wait_for_workers(self, room: "nio.MatrixRoom", event: "nio.Event") -> None:
+        """
+        Pauses the sync loop while the messages forwarded to a worker pile up unread
+        """
+        for writer in list(self._workers):
+            if writer.transport.is_closing():
+                continue
+            try:
+                await writer.drain()
+            except ConnectionError:
+                log.warning("Worker lost while waiting for it to catch up")
+
+    async def _serve_worker(self) -> bool:
+        """
+        Worker side: receives the messages from the leader and hands them to the plugins
+        """
+        reader, self._leader = await asyncio.open_unix_connection(self.leader_socket, limit=IPC_LINE_LIMIT)
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    log.info("Connection to the leader lost")
+                    return False
+                message = json_loads(line)
+                if message['type'] == "hello":
+                    self.client.user_id = message['user_id']
+                    self.bot_identifier = MatrixNioPerson(message['user_id'],
+                                                          client=self.client,
+                                                          full_name=message['full_name'],
+                                                          emails=[message['user_id']])
+                    self.connect_callback()
+                    self.reset_reconnection_count()
+                elif message['type'] == "message":
+                    loop.run_in_executor(self._dispatch_executor, self._handle_leader_message, message)
+                else:
+                    future = self._leader_requests.pop(message['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        finally:
+            self._leader.close()
+            self._leader = None
+            for future in self._leader_requests.values():
+                future.cancel()
+            self._leader_requests = {}
+
+    def _handle_leader_message(self, message: dict) -> None:
+        room_id = message['room_id']
+        matrix_room = self.client.rooms.get(room_id)
+        if matrix_room is None:
+            matrix_room = nio.MatrixRoom(room_id, self.client.user_id)
+            self.client.rooms[room_id] = matrix_room
+        matrix_room.name = message['room_name']
+        message_instance = self.build_message(message['body'])
+        message_instance.frm = MatrixNioRoomOccupant(
+            message['sender'],
+            full_name=message['sender_name'],
+            emails=[message['sender']],
+            client=self.client,
+            room=room_id,
+            power_level=message['power_level']
+        )
+        message_instance.to = MatrixNioRoom(
+            room_id,
+            title=message['room_name'],
+            subject=message['room_display_name'],
+            client=self.client,
+            backend=self
+        )
+        try:
+            with self.profiler.span('dispatch'):
+                self.callback_message(message_instance)
+        except Exception:
+            log.exception(f"Error while dispatching {message}")
+
+    async def _request_leader(self, request: dict) -> dict:
+        """
+        Worker side: sends a request to the leader, whose client is the one logged in, and waits for its reply
+        """
+        if self._leader is None:
+            raise ValueError("Not connected to the leader")
+        self._leader_request_id += 1
+        request['id'] = self._leader_request_id
+        future = asyncio.get_event_loop().create_future()
+        self._leader_requests[request['id']] = future
+        _write_line(self._leader, request)
+        reply = await future
+        if reply['type'] == "error":
+            raise ValueError(reply['error'])
+        return reply
+
+    def _notify_leader(self, request: dict) -> None:
+        if self._leader is None:
+            log.warning(f"Not connected to the leader, dropping {request}")
+            return
+        _write_line(self._leader, request)
+
+    async def _send_to_leader(self, target: dict, content: dict, priority: bool = False) -> "nio.RoomSendResponse":
+        reply = await self._request_leader(dict(target, type="send", content=content, priority=priority))
+        return nio.RoomSendResponse.from_dict({'event_id': reply['event_id']}, reply['room_id'])
+
+    @staticmethod
+    def _leader_target(target: Identifier) -> dict:
+        """
+        How a worker designates a recipient, the direct message rooms being created by the leader
+        """
+        room = target.id if isinstance(target, MatrixNioRoom) else getattr(target, 'room', None)
+        return {'room_id': str(room)} if room is not None else {'user_id': target.id}
+
+    @property
+    def _dispatch_queue(self) -> asyncio.Queue:
+        """
+        Messages waiting for the dispatch thread, kept across reconnections so that none is dropped.
+        Created on first use, from the backend loop, as queues are bound to a loop before Python 3.10.
+        """
+        if self._pending_messages is None:
+            self._pending_messages = asyncio.Queue(self.pipeline_queue_size)
+        return self._pending_messages
+
+    async def _enqueue_message(self, room: "nio.MatrixRoom", event: "nio.Event") -> None:
+        if not self.accepting_messages:
+            return
+        # Blocks the sync loop, and thus the next fetch, while the dispatch queue is full
+        await self._dispatch_queue.put((room, event))
+
+    async def _dispatch_forever(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            room, event = await self._dispatch_queue.get()
+            try:
+                if room is None:
+                    # Queued by handle_sync: every message of the syncs up to this token was dispatched
+                    self._sync_token = event
+                else:
+                    await loop.run_in_executor(self._dispatch_executor, self.handle_message, room, event)
+            except asyncio.CancelledError:
+                # An Exception before Python 3.8, it must stop the dispatcher when disconnecting
+                raise
+            except Exception:
+                log.exception(f"Error while dispatching {event}")
+            finally:
+                self._dispatch_queue.task_done()
+
+    async def _stop_background_tasks(self) -> None:
+        tasks, self._background_tasks = self._background_tasks, []
+        if self._invite_batch is not None:
+            tasks.append(self._invite_batch)
+        tasks.extend(self._room_warm_ups)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._read_markers:
+            await self._send_read_markers()
+        self._save_state()
+
+    def _data_path(self, filename: str) -> str:
+        return os.path.join(self.bot_config.BOT_DATA_DIR, filename)
+
+    def _save_state(self) -> None:
+        if self.recorder is not None:
+            self.recorder.flush()
+        percentiles = self.watchdog.percentiles() if self.watchdog is not None else {}
+        if percentiles:
+            log.info("Event loop lag: " + ", ".join(f"{name} {lag * 1000:.1f} ms" for name, lag in percentiles.items()))
+        if self.persist_deduplicator:
+            self.deduplicator.save(self._data_path('matrix_nio_events.json'))
+        if self.catch_up and self._sync_token:
+            _write_json(self._data_path('matrix_nio_sync.json'), {'next_batch': self._sync_token})
+
+    def _load_sync_token(self) -> Optional[str]:
+        return _read_json(self._data_path('matrix_nio_sync.json'), {}).get('next_batch')
+
+    async def _catch_up(self, sync_response: "nio.SyncResponse", since: str) -> None:
+        """
+        Dispatches the messages missed while the bot was down, oldest first, in batches of
+        MATRIX_NIO_CATCH_UP_BATCH_SIZE messages separated by MATRIX_NIO_CATCH_UP_BATCH_DELAY milliseconds.
+        Messages older than MATRIX_NIO_CATCH_UP_MAX_AGE seconds are skipped. The rooms with more missed
+        messages than the sync returned are paginated back to `since`.
+        """
+        cutoff = (time.time() - self.catch_up_max_age) * 1000
+        message_types = self._message_types()
+        missed = []
+        for room_id, join_info in sync_response.rooms.join.items():
+            events = list(join_info.timeline.events)
+            if join_info.timeline.limited:
+                events.extend(await self._fetch_missed_events(room_id, join_info.timeline.prev_batch, since, cutoff))
+            for event in events:
+                if isinstance(event, message_types) and event.server_timestamp >= cutoff:
+                    missed.append((self.client.rooms[room_id], event))
+        missed.sort(key=lambda room_event: room_event[1].server_timestamp)
+        log.info(f"Catching up on {len(missed)} missed messages")
+        if missed and self.pipeline:
+            self._start_background_tasks()
+        for start in range(0, len(missed), self.catch_up_batch_size):
+            if start:
+                await asyncio.sleep(self.catch_up_batch_delay)
+            for room, event in missed[start:start + self.catch_up_batch_size]:
+                if self.pipeline:
+                    await self._enqueue_message(room, event)
+                else:
+                    self.handle_message(room, event)
+            if self.pipeline:
+                await self._dispatch_queue.join()
+            # Saved after every batch, so that a crash does not process it again
+            self.deduplicator.save(self._data_path('matrix_nio_events.json'))
+
+    async def _fetch_missed_events(self, room_id: str, start: Optional[str], end: str, cutoff: float) -> list:
+        """
+        Paginates back from `start` to `end` the events left out of a limited sync timeline
+        :return: the events, newest first, stopping at the first one older than `cutoff`
+        """
+        events = []  # type: list
+        while start:
+            response = await self.client.room_messages(room_id, start=start, end=end, limit=CATCH_UP_PAGE_SIZE)
+            if isinstance(response, nio.RoomMessagesError):
+                log.warning(f"Could not fetch the missed messages of {room_id}: {response}")
+                break
+            events.extend(response.chunk)
+            if not response.chunk or response.chunk[-1].server_timestamp < cutoff or response.end == start:
+                break
+            start = response.end
+        return events
+
+    async def _save_state_forever(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            self._save_state()
+
+    async def _send_read_markers_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.read_markers_interval / 1000)
+            await self._send_read_markers()
+
+    async def _send_read_markers(self) -> None:
+        """
+        Acknowledges the latest processed event of every room with new messages since the last call.
+        """
+        read_markers, self._read_markers = self._read_markers, {}
+        results = await asyncio.gather(*(
+            self.client.room_read_markers(room_id, fully_read_event=event_id, read_event=event_id)
+            for room_id, event_id in read_markers.items()
+        ))
+        for result in results:
+            if isinstance(result, nio.responses.RoomReadMarkersError):
+                log.warning(f"Error while sending read markers {result}")
+
+    def room_power_levels(self, room: "nio.MatrixRoom") -> MatrixNioPowerLevels:
+        """
+        The power levels of a room, built from the room state the first time, then updated from events
+        """
+        power_levels = self.power_levels.get(room.room_id)
+        if power_levels is None:
+            power_levels = MatrixNioPowerLevels.from_power_levels(room.power_levels)
+            self.power_levels[room.room_id] = power_levels
+        return power_levels
+
+    async def handle_sync(self, response: "nio.SyncResponse") -> None:
+        # Once shutting down, the messages of a sync still in flight are dropped and fetched again on restart
+        if not self.accepting_messages:
+            return
+        if self.pipeline:
+            # Saved only once the messages queued before it are dispatched, so that catching up recovers them
+            await self._dispatch_queue.put((None, response.next_batch))
+        else:
+            self._sync_token = response.next_batch
+
+    def handle_power_levels(self, room: "nio.MatrixRoom", event: "nio.PowerLevelsEvent") -> None:
+        self.room_power_levels(room).update(event.power_levels)
+
+    def invite_allowed(self, inviter: str) -> bool:
+        """
+        Whether an invite sent by `inviter` is accepted with MATRIX_NIO_AUTO_ACCEPT_INVITES
+        """
+        if inviter in self.invite_users or inviter in getattr(self.bot_config, 'BOT_ADMINS', ()):
+            return True
+        return inviter.partition(':')[2] in self.invite_servers
+
+    def handle_invite(self, room: "nio.MatrixInvitedRoom", event: "nio.InviteMemberEvent") -> None:
+        if event.membership != 'invite' or event.state_key != self.client.user_id:
+            return
+        self._queue_invite(room.room_id, event.sender)
+
+    def _queue_invite(self, room_id: str, inviter: str) -> None:
+        if room_id in self.client.rooms or room_id in self._invites:
+            return
+        if not self.invite_allowed(inviter):
+            log.info(f"Invite to {room_id} from {inviter} ignored")
+            return
+        self._invites[room_id] = inviter
+        if self._invite_batch is None:
+            # Runs once the sync response is handled, accepting all the invites it holds together
+            self._invite_batch = asyncio.ensure_future(self._accept_invites())
+
+    async def _accept_invites(self) -> None:
+        """
+        Joins the rooms of the queued invites, at most MATRIX_NIO_INVITE_CONCURRENCY at a time,
+        then warms each room up in the background
+        """
+        semaphore = asyncio.Semaphore(self.invite_concurrency)
+
+        async def accept(room_id: str, inviter: str) -> None:
+            async with semaphore:
+                result = await self.client.join(room_id)
+            if isinstance(result, nio.responses.JoinError):
+                log.warning(f"Error while accepting the invite to {room_id} from {inviter}: {result}")
+                return
+            log.info(f"Joined {room_id}, invited by {inviter}")
+            task = asyncio.ensure_future(self.warm_up_room(room_id, inviter))
+            self._room_warm_ups.add(task)
+            task.add_done_callback(self._room_warm_ups.discard)
+
+        try:
+            while self._invites:
+                invites, self._invites = self._invites, {}
+                await asyncio.gather(*(accept(room_id, inviter) for room_id, inviter in invites.items()))
+        finally:
+            self._invite_batch = None
+
+    async def warm_up_room(self, room_id: str, inviter: Optional[str] = None) -> None:
+        """
+        Loads the state and the members of a newly joined room, and the profile of whoever invited the bot,
+        so that the first command in the room does not wait for them
+        """
+        with self.profiler.span('warm_up'):
+            state, _ = await asyncio.gather(
+                self.client.room_get_state(room_id),
+                self.prefetch_identifiers([inviter] if inviter else [])
+            )
+            if isinstance(state, nio.responses.RoomGetStateError):
+                log.warning(f"Error while loading the state of {room_id}: {state}")
+                return
+            if room_id not in self.client.rooms:
+                # Otherwise the sync of the join came first, with a state at least as recent
+                encrypted_rooms = set()  # type: set
+                events = [nio.Event.parse_event(event) for event in state.events]
+                self.client._handle_joined_state(
+                    room_id, nio.RoomInfo(nio.Timeline([], False, None), events, [], []), encrypted_rooms
+                )
+                self.client.encrypted_rooms.update(encrypted_rooms)
+            room = self.client.rooms[room_id]
+            self.room_power_levels(room)
+            if room.canonical_alias:
+                self.aliases.put(room.canonical_alias, room_id)
+
+    def send_message(self, msg: Message) -> "nio.RoomSendResponse":
+        log.debug(f"Sending message {msg}")
+        super().send_message(msg)
+        result = asyncio.run_coroutine_threadsafe(self._send_message(msg), self._get_loop())
+        self._scheduled_sends.add(result)
+        result.add_done_callback(self._scheduled_sends.discard)
+        return result
+
+    async def _send_message(self, msg: Message) -> "nio.RoomSendResponse":
+        msg_data = {
+            'msgtype': "m.text",
+            'body': msg.body
+        }
+        # The replies to admin commands go first, flagged by _process_command and build_reply
+        priority = msg.extras.get('admin_command', False)
+        if self.role == 'worker':
+            return await self._send_to_leader(self._leader_target(msg.to), msg_data, priority)
+        room_id = await self._message_room_id(msg)
+        result = await self._room_send(room_id, msg_data, priority=priority)
+        await self._stop_typing(room_id)
+        return result
+
+    async def _room_send(self, room_id: str, content: dict, priority: bool = False) -> "nio.RoomSendResponse":
+        # Tracked so that shutdown can wait for messages being sent
+        task = asyncio.ensure_future(self._schedule_room_send(room_id, content, priority))
+        self._pending_sends.add(task)
+        task.add_done_callback(self._pending_sends.discard)
+        with self.profiler.span('send'):
+            return await task
+
+    async def _schedule_room_send(self, room_id: str, content: dict, priority: bool) -> "nio.RoomSendResponse":
+        if self.role == 'worker':
+            return await self._send_to_leader({'room_id': room_id}, content, priority)
+
+        def send() -> Awaitable:
+            return self.client.room_send(
+                room_id=room_id,
+                message_type='m.room.message',
+                content=content
+            )
+
+        if self.send_scheduler is not None:
+            result = await self.send_scheduler.submit(room_id, send, priority)
+        else:
+            result = await send()
+        # TODO RoomSendError not trapped properly
+        if isinstance(result, nio.RoomSendResponse):
+            if self.recorder is not None:
+                self.recorder.record('send', room_id=room_id, content=content, event_id=result.event_id)
+            return result
+        else:
+            raise ValueError(f"An exception occurred while trying to send the following message "
+                             f"to {room_id}: {content['body']}\n{result}")
+
+    async def _message_room_id(self, msg: Message) -> str:
+        return await self._target_room_id(msg.to)
+
+    async def _target_room_id(self, target: Identifier) -> str:
+        if isinstance(target, MatrixNioRoom):
+            return target.id
+        room = getattr(target, 'room', None)
+        if room is not None:
+            return str(room)
+        return await self.get_direct_room(target.id)
+
+    def send_broadcast(self, body: str, targets: Iterable[Union[str, Identifier]],
+                       timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Broadcasts a message, from a plugin thread. See broadcast.
+        Raises ValueError on the event loop thread (e.g. in callback_message), await broadcast there.
+        """
+        return self._run_blocking(self.broadcast(body, targets, timeout))
+
+    async def broadcast(self, body: str, targets: Iterable[Union[str, Identifier]],
+                        timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Sends the same message to many rooms concurrently, at most MATRIX_NIO_BROADCAST_CONCURRENCY at a time
+        and within the MATRIX_NIO_SEND_RATE budget if any. Unlike send_message, the plugins' callback_botmessage
+        is not called.
+        :param targets: room ids, room aliases, rooms or persons (sent to their direct message room)
+        :param timeout: seconds after which the messages not sent yet are given up,
+                        MATRIX_NIO_BROADCAST_TIMEOUT by default
+        :return: room id (or unresolved target) -> nio.RoomSendResponse, or the exception raised by its send
+        """
+        if timeout is None:
+            timeout = self.broadcast_timeout
+        if self.role == 'worker':
+            return await self._broadcast_through_leader(body, targets, timeout)
+        # Rendered once, shared by every send
+        content = {
+            'msgtype': "m.text",
+            'body': body
+        }
+        outcomes = {}  # type: Dict[str, Any]
+        room_ids = OrderedDict()  # type: OrderedDict
+        aliases = []
+        persons = []
+        for target in targets:
+            if isinstance(target, str):
+                if target.startswith('#'):
+                    aliases.append(target)
+                else:
+                    room_ids[target] = None
+            else:
+                persons.append(target)
+        for alias, room_id in (await self.resolve_room_aliases(aliases)).items():
+            if room_id is None:
+                outcomes[alias] = MatrixNioRoomError(f"Unknown room alias {alias}")
+            else:
+                room_ids[room_id] = None
+        for target, resolved in zip(persons, await asyncio.gather(
+                *(self._target_room_id(target) for target in persons), return_exceptions=True)):
+            if isinstance(resolved, BaseException):
+                outcomes[str(target)] = resolved
+            else:
+                room_ids[resolved] = None
+
+        semaphore = asyncio.Semaphore(self.broadcast_concurrency)
+
+        async def send(room_id: str) -> "nio.RoomSendResponse":
+            async with semaphore:
+                return await self._room_send(room_id, content)
+
+        sends = {asyncio.ensure_future(send(room_id)): room_id for room_id in room_ids}
+        if sends:
+            _, pending = await asyncio.wait(sends, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            for task, room_id in sends.items():
+                if task in pending:
+                    outcomes[room_id] = asyncio.TimeoutError(f"Broadcast to {room_id} timed out")
+                elif task.exception() is not None:
+                    outcomes[room_id] = task.exception()
+                else:
+                    outcomes[room_id] = task.result()
+        failures = sum(isinstance(outcome, Exception) for outcome in outcomes.values())
+        if failures:
+            log.warning(f"Broadcast failed for {failures} of {len(outcomes)} rooms")
+        return outcomes
+
+    async def _broadcast_through_leader(self, body: str, targets: Iterable[Union[str, Identifier]],
+                                        timeout: Optional[float]) -> Dict[str, Any]:
+        reply = await self._request_leader({
+            'type': "broadcast",
+            'body': body,
+            'targets': [target if isinstance(target, str) else self._leader_target(target) for target in targets],
+            'timeout': timeout
+        })
+        return {
+            key: ValueError(outcome['error']) if 'error' in outcome
+            else nio.RoomSendResponse.from_dict({'event_id': outcome['event_id']}, outcome['room_id'])
+            for key, outcome in reply['outcomes'].items()
+        }
+
+    def handle_account_data(self, event: "nio.UnknownAccountDataEvent") -> None:
+        if event.type != "m.direct":
+            return
+        self._direct_rooms_content = event.content
+        direct_rooms = {}
+        for user_id, room_ids in event.content.items():
+            for room_id in reversed(room_ids):
+                if room_id in self.client.rooms:
+                    direct_rooms[user_id] = room_id
+                    break
+        self.direct_rooms = direct_rooms
+
+    async def get_direct_room(self, user_id: str) -> str:
+        """
+        The direct message room shared with a user, created if needed.
+        Concurrent calls for the same user share a single room creation.
+        """
+        room_id = self.direct_rooms.get(user_id)
+        if room_id is not None:
+            return room_id
+        return await _in_flight(self._direct_room_creations, user_id, lambda: self._create_direct_room(user_id))
+
+    async def _create_direct_room(self, user_id: str) -> str:
+        log.info(f"Creating direct message room with {user_id}")
+        result = await self.client.room_create(
+            is_direct=True,
+            invite=[user_id],
+            preset=nio.RoomPreset.trusted_private_chat
+        )
+        if isinstance(result, nio.responses.RoomCreateError):
+            raise MatrixNioRoomError(result)
+        self.direct_rooms[user_id] = result.room_id
+        self._direct_rooms_content = dict(self._direct_rooms_content)
+        self._direct_rooms_content[user_id] = self._direct_rooms_content.get(user_id, []) + [result.room_id]
+        account_data_result = await self.client.set_direct_rooms(self._direct_rooms_content)
+        if isinstance(account_data_result, nio.ErrorResponse):
+            log.warning(f"Error while updating direct message rooms {account_data_result}")
+        return result.room_id
+
+    def send_editable_message(self, msg: Message) -> MatrixNioEditableMessage:
+        """
+        Sends a message that can later be updated in place with `MatrixNioEditableMessage.update`.
+        Edits are coalesced and sent at most once every MATRIX_NIO_EDIT_INTERVAL milliseconds.
+        """
+        log.debug(f"Sending editable message {msg}")
+        loop = self._get_loop()
+        editable = MatrixNioEditableMessage(self, msg.body, self.edit_interval, loop)
+        result = asyncio.run_coroutine_threadsafe(self._send_message(msg), loop)
+        result.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(editable._set_event_id, future)
+        )
+        return editable
 
     def connect_callback(self) -> None:
         # TODO implement this
@@ -372,22 +2668,127 @@ class MatrixNioBackend(ErrBot):
         return msg.frm.id == self.client.user_id
 
     def change_presence(self, status: str = ONLINE, message: str = '') -> None:
-        # TODO implement this
-        # At this time, this backend doesn't support presence
-        pass
+        log.debug(f"Change presence to {status}: {message}")
+        if self.role == 'worker':
+            self._get_loop().call_soon_threadsafe(self._notify_leader, {
+                'type': "presence",
+                'status': status,
+                'message': message
+            })
+            return
+        self._presence_wanted = (PRESENCE_MAPPING.get(status, "online"), message or None)
+        self._get_loop().call_soon_threadsafe(self._schedule_presence)
+
+    def _schedule_presence(self) -> None:
+        # Several changes requested while an update is in flight are coalesced into the next one
+        if self._presence_task is None:
+            self._presence_task = asyncio.ensure_future(self._update_presence())
+
+    async def _update_presence(self) -> None:
+        try:
+            while self._presence_wanted != self._presence_sent:
+                wanted = self._presence_wanted
+                if wanted is None:
+                    return
+                result = await self.client.set_presence(*wanted)
+                if isinstance(result, nio.responses.PresenceSetError):
+                    log.error(f"Error while setting presence {result}")
+                    return
+                self._presence_sent = wanted
+        finally:
+            self._presence_task = None
+
+    def _is_command(self, msg: Message) -> bool:
+        """
+        Whether errbot will look for a command in the message, the prefix checks of ErrBot.process_message
+        """
+        text = msg.body.lower() if self.bot_config.BOT_ALT_PREFIX_CASEINSENSITIVE else msg.body
+        if self.bot_config.BOT_ALT_PREFIXES and text.startswith(self.bot_alt_prefixes):
+            return True
+        if msg.is_direct and getattr(self.bot_config, 'BOT_PREFIX_OPTIONAL_ON_CHAT', False):
+            return True
+        return msg.body.startswith(self.bot_config.BOT_PREFIX)
+
+    def _start_typing(self, room_id: str) -> None:
+        now = time.monotonic()
+        if now - self._typing_refreshed.get(room_id, float("-inf")) < self.typing_timeout / 1000:
+            return
+        self._typing_refreshed[room_id] = now
+        asyncio.run_coroutine_threadsafe(self._send_typing(room_id, True), self._get_loop())
+
+    async def _stop_typing(self, room_id: str) -> None:
+        if self._typing_refreshed.pop(room_id, None) is not None:
+            await self._send_typing(room_id, False)
+
+    async def _send_typing(self, room_id: str, typing_state: bool) -> None:
+        result = await self.client.room_typing(room_id, typing_state, timeout=self.typing_timeout)
+        if isinstance(result, nio.responses.RoomTypingError):
+            log.warning(f"Error while sending typing notification {result}")
 
     async def build_identifier(self, txtrep: str) -> MatrixNioPerson:
         log.debug(f"Build id : {txtrep}")
-        profile = await asyncio.gather(
-            self.client.get_profile(txtrep)
-        )
-        if len(profile) == 1 and isinstance(profile[0], nio.responses.ProfileGetResponse):
-            return MatrixNioPerson(txtrep,
-                                   full_name=profile[0].displayname,
-                                   emails=[txtrep],
-                                   client=self.client)
-        else:
+        identifier = self.identifiers.get(txtrep)
+        if identifier is not None:
+            return identifier
+        return await _in_flight(self._profile_requests, txtrep, lambda: self._fetch_identifier(txtrep))
+
+    async def _fetch_identifier(self, user_id: str) -> MatrixNioPerson:
+        profile = await self.client.get_profile(user_id)
+        if not isinstance(profile, nio.responses.ProfileGetResponse):
             raise ValueError(f"An error occured while fetching identifier: {profile}")
+        identifier = MatrixNioPerson(user_id,
+                                     full_name=profile.displayname,
+                                     emails=[user_id],
+                                     client=self.client)
+        self.identifiers.put(user_id, identifier)
+        return identifier
+
+    @property
+    def media(self) -> MatrixNioMediaCache:
+        """
+        Cache of the downloaded media, bounded to MATRIX_NIO_MEDIA_CACHE_SIZE bytes
+        :return: MatrixNioMediaCache
+        """
+        if self._media is None:
+            self._media = MatrixNioMediaCache(
+                self._data_path('matrix_nio_media'),
+                getattr(self.bot_config, 'MATRIX_NIO_MEDIA_CACHE_SIZE', 100 * 1024 * 1024)
+            )
+        return self._media
+
+    async def download_media(self, url: str) -> str:
+        """
+        Downloads an mxc:// URL through the media cache in BOT_DATA_DIR
+        :return: the path of the cached file
+        """
+        return await self.media.fetch(url, lambda path: self._download_media(url, path))
+
+    async def _download_media(self, url: str, path: str) -> None:
+        log.debug(f"Downloading {url}")
+        # Streamed to the file rather than kept in memory
+        result = await self.client.download(mxc=url, save_to=path)
+        if isinstance(result, nio.responses.DownloadError):
+            raise ValueError(f"An error occurred while downloading {url}: {result}")
+
+    async def prefetch_identifiers(self, user_ids: List[str]) -> Dict[str, Optional[MatrixNioPerson]]:
+        """
+        Fetches the profiles of many users concurrently, at most MATRIX_NIO_PROFILE_CONCURRENCY at a time,
+        so that the following build_identifier calls are answered from the cache
+        :return: user_id -> identifier or None if the profile could not be fetched
+        """
+        semaphore = asyncio.Semaphore(self.profile_concurrency)
+
+        async def fetch(user_id: str) -> Optional[MatrixNioPerson]:
+            async with semaphore:
+                try:
+                    return await self.build_identifier(user_id)
+                except ValueError:
+                    log.warning(f"Profile of {user_id} not prefetched", exc_info=True)
+                    return None
+
+        unique_user_ids = list(OrderedDict.fromkeys(user_ids))
+        identifiers = await asyncio.gather(*(fetch(user_id) for user_id in unique_user_ids))
+        return dict(zip(unique_user_ids, identifiers))
 
     def build_reply(self,
                     msg: Message,
@@ -396,23 +2797,145 @@ class MatrixNioBackend(ErrBot):
                     threaded: bool = False) -> Message:
         # TODO : Include marker for threaded response
         response = self.build_message(f"{msg.body}\n{text}")
-        response.to = msg.frm
+        if private:
+            # A person without a room is answered in its direct message room
+            response.to = MatrixNioPerson(msg.frm.id,
+                                          client=self.client,
+                                          full_name=msg.frm.fullname,
+                                          emails=msg.frm.emails)
+        else:
+            response.to = msg.frm
+        if msg.extras.get('admin_command'):
+            response.extras['admin_command'] = True
         return response
 
+    def _process_command(self, msg: Message, cmd: str, args: str, match) -> None:
+        with self._gbl:
+            command = self.re_commands.get(cmd) if match else self.commands.get(cmd)
+        # Flags the message so that the replies to admin commands are sent first
+        if getattr(command, '_err_command_admin_only', False):
+            msg.extras['admin_command'] = True
+        super()._process_command(msg, cmd, args, match)
+
     @property
     def mode(self) -> str:
         return "matrix-nio"
 
+    def handle_canonical_alias(self, room: "nio.MatrixRoom", event: "nio.RoomAliasEvent") -> None:
+        if event.canonical_alias:
+            self.aliases.put(event.canonical_alias, room.room_id)
+
+    async def resolve_room_alias(self, alias: str) -> Optional[str]:
+        """
+        Resolves a room alias such as #room:example.org, using the alias cache when possible
+        :return: the room_id or None if the alias is unknown
+        """
+        room_id = self.aliases.get(alias)
+        if room_id is not None:
+            return room_id
+        result = await self.client.room_resolve_alias(alias)
+        if isinstance(result, nio.responses.RoomResolveAliasError):
+            log.warning(f"Error while resolving room alias {alias}: {result}")
+            return None
+        self.aliases.put(alias, result.room_id)
+        return result.room_id
+
+    async def resolve_room_aliases(self, aliases: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Resolves many room aliases concurrently, at most MATRIX_NIO_ALIAS_CONCURRENCY at a time
+        :return: alias -> room_id or None if the alias is unknown
+        """
+        semaphore = asyncio.Semaphore(self.alias_concurrency)
+
+        async def resolve(alias: str) -> Optional[str]:
+            async with semaphore:
+                return await self.resolve_room_alias(alias)
+
+        unique_aliases = list(OrderedDict.fromkeys(aliases))
+        room_ids = await asyncio.gather(*(resolve(alias) for alias in unique_aliases))
+        return dict(zip(unique_aliases, room_ids))
+
+    def start_profiling(self) -> None:
+        """
+        Starts a cProfile session of the event loop thread, and of the dispatch thread with MATRIX_NIO_PIPELINE.
+        Does not wait for the threads, commands may run on either of them.
+        """
+        self.profiling = True
+        self._call_soon(self.profiler.start_profile)
+        if self.pipeline:
+            self._dispatch_executor.submit(self.profiler.start_profile)
+
+    def stop_profiling(self) -> str:
+        """
+        Stops the cProfile session, the profile is saved once every profiled thread has stopped
+        :return: the path of the pstats file, in BOT_DATA_DIR
+        """
+        self.profiling = False
+        path = self._data_path(f"matrix_nio_profile_{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        self._call_soon(self._stop_profiling, path)
+        return path
+
+    def _stop_profiling(self, path: str) -> None:
+        self.profiler.stop_profile()
+        if self.pipeline:
+            stopped = self._dispatch_executor.submit(self.profiler.stop_profile)
+            stopped.add_done_callback(lambda _: self._dump_profile(path))
+        else:
+            self._dump_profile(path)
+
+    def _dump_profile(self, path: str) -> None:
+        try:
+            self.profiler.dump_profile(path)
+        except ValueError as e:
+            log.warning(f"Could not save the profile to {path}: {e}")
+        else:
+            log.info(f"Profile saved to {path}")
+
+    def _call_soon(self, function: Callable, *args: Any) -> None:
+        """
+        Runs a function on the backend loop without waiting for it, right away if the loop is not running
+        """
+        loop = self._get_loop()
+        if loop.is_running():
+            loop.call_soon_threadsafe(function, *args)
+        else:
+            function(*args)
+
+    def _on_loop_thread(self) -> bool:
+        return self._get_loop().is_running() and threading.current_thread() is self._loop_thread
+
+    def _run_blocking(self, coroutine) -> Any:
+        """
+        Runs a coroutine on the backend loop and waits for its result.
+        Raises ValueError on the loop thread itself, which would wait for itself forever.
+        """
+        if self._on_loop_thread():
+            coroutine.close()
+            raise ValueError(f"{coroutine.__qualname__} cannot be waited for from the event loop thread, "
+                             f"await it instead")
+        loop = self._get_loop()
+        if loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+        return loop.run_until_complete(coroutine)
+
     def query_room(self, room) -> Optional[MatrixNioRoom]:
+        if room.startswith('#'):
+            room_id = self.aliases.get(room)
+            if room_id is None:
+                if self._on_loop_thread():
+                    log.warning(f"Room alias {room} is not cached and cannot be resolved from the event loop")
+                    return None
+                room_id = self._run_blocking(self.resolve_room_alias(room))
+            room = room_id
         if room in self.client.rooms:
-            return MatrixNioRoom.from_matrix_room(self.client.rooms[room], self.client)
+            return MatrixNioRoom.from_matrix_room(self.client.rooms[room], self.client, backend=self)
         else:
             return None
 
     def rooms(self) -> Optional[Dict[str, MatrixNioRoom]]:
         result = {}
         for matrix_room in self.client.rooms.values():
-            result[matrix_room.room_id] = MatrixNioRoom.from_matrix_room(matrix_room, self.client)
+            result[matrix_room.room_id] = MatrixNioRoom.from_matrix_room(matrix_room, self.client, backend=self)
         return result
 
     def prefix_groupchat_reply(self, message: Message, identifier: MatrixNioPerson) -> None:
@@ -27,6 +27,10 @@ setup(
             "peewee>=3.9.5",
             "cachetools",
             "atomicwrites",
+        ],
+        "speedups": [
+            "orjson",
+            "uvloop; sys_platform != 'win32'",
         ]
     },
     zip_safe=False
@@ -3,12 +3,17 @@ import copy
 import json
 import logging
 import os
+import pstats
+import tempfile
+import threading
+import time
 import unittest
 from unittest import TestCase
 from unittest import mock
 from unittest.mock import call
 
 import aiounittest
+import pytest
 import nio
 from errbot import Message
 from errbot.core import ErrBot
@@ -19,6 +24,31 @@ from nio import MatrixUser, JoinedRoomsResponse, JoinedRoomsError, ProfileGetRes
 import matrix_nio
 
 matrix_nio.log.setLevel(logging.DEBUG)
+# Defines the classes extending nio, served lazily by the module itself from Python 3.7
+matrix_nio._load_nio()
+
+
+class ConcurrentCalls(object):
+    """
+    Stands for a slow client method: records the calls and how many of them were pending at once
+    """
+
+    def __init__(self, respond, delay=0.01):
+        self.respond = respond
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, *args, **kwargs):
+        self.calls.append(call(*args, **kwargs))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return self.respond(*args, **kwargs)
 
 
 class TestMatrixNioRoomError(TestCase):
@@ -141,6 +171,8 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         self.title = "A title"
         self.topic = "a_topic"
         self.display_name = "a_display_name"
+        # Stands for the backend, which runs the requests of the blocking room methods on its loop
+        self.backend = mock.Mock(_run_blocking=asyncio.get_event_loop().run_until_complete)
         self.room1 = matrix_nio.MatrixNioRoom(self.room_id,
                                               client=self.client,
                                               title=self.title,
@@ -153,7 +185,7 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
             matrix_nio.MatrixNioRoomOccupant("12345", "Charles de Gaulle", self.client),
             matrix_nio.MatrixNioRoomOccupant("54321", "Georges Pompidou", self.client)
         ]
-        self.room1.matrix_room.users = self.users
+        self.room1.matrix_room.users = {user.user_id: user for user in self.users}
         self.room1.matrix_room.own_user_id = self.owner
         self.room1.matrix_room.topic = self.topic
         self.room1.matrix_room.name = self.display_name
@@ -170,7 +202,7 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         self.assertEqual(matrix_nio_room.id, matrix_room.room_id)
 
     def test_matrix_nio_room_aclattr(self):
-        self.assertEqual(self.room1.aclattr, self.owner)
+        self.assertEqual(self.room1.aclattr, self.room_id)
 
     def test_matrix_nio_room_topic(self):
         self.assertEqual(self.room1.topic, self.topic)
@@ -273,11 +305,13 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         errbot_nio_room1 = matrix_nio.MatrixNioRoom("nio_room1",
                                                     client=matrix_client,
                                                     title="nio_room1 title",
-                                                    subject="nio_room1 subject")
+                                                    subject="nio_room1 subject",
+                                                    backend=self.backend)
         errbot_nio_room2 = matrix_nio.MatrixNioRoom("nio_room2",
                                                     client=matrix_client,
                                                     title="nio_room2 title",
-                                                    subject="nio_room2 subject")
+                                                    subject="nio_room2 subject",
+                                                    backend=self.backend)
         matrix_client.joined_rooms = mock.Mock(
             return_value=aiounittest.futurized(
                 JoinedRoomsResponse.from_dict({
@@ -313,7 +347,8 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         errbot_nio_room1 = matrix_nio.MatrixNioRoom("nio_room1",
                                                     client=matrix_client,
                                                     title="nio_room1 title",
-                                                    subject="nio_room1 subject")
+                                                    subject="nio_room1 subject",
+                                                    backend=self.backend)
         matrix_client.joined_rooms = mock.Mock(
             return_value=aiounittest.futurized(
                 JoinedRoomsError.from_dict({
@@ -341,7 +376,8 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         nio_room1 = matrix_nio.MatrixNioRoom("nio_room1",
                                              client=matrix_client,
                                              title="nio_room1 title",
-                                             subject="nio_room1 subject")
+                                             subject="nio_room1 subject",
+                                             backend=self.backend)
         matrix_client.room_forget = mock.Mock(
             return_value=aiounittest.futurized(
                 RoomForgetResponse.from_dict({
@@ -362,7 +398,8 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
         nio_room1 = matrix_nio.MatrixNioRoom("nio_room1",
                                              client=matrix_client,
                                              title="nio_room1 title",
-                                             subject="nio_room1 subject")
+                                             subject="nio_room1 subject",
+                                             backend=self.backend)
         matrix_client.room_forget = mock.Mock(
             return_value=aiounittest.futurized(
                 RoomForgetError.from_dict({
@@ -379,6 +416,125 @@ class TestMatrixNioRoom(aiounittest.AsyncTestCase):
             nio_room1.destroy()
         matrix_client.room_forget.assert_called_once_with("nio_room1")
 
+    def test_matrix_nio_room_unbound(self):
+        # Rooms are bound to the backend that built them, whose loop runs their requests
+        with self.assertRaises(ValueError):
+            self.room1.joined
+
+
+class TestMatrixNioCompactRoom(TestCase):
+    def setUp(self) -> None:
+        self.database = matrix_nio.MatrixNioMemberDatabase(":memory:")
+        self.room = matrix_nio.MatrixNioCompactRoom("test_room", "test_user", database=self.database, cache_size=2)
+        for user_id, display_name in (("@charles:colombay.fr", "Charles de Gaulle"),
+                                      ("@georges:elysee.fr", "Georges Pompidou"),
+                                      ("@valery:elysee.fr", "Valéry Giscard d'Estaing")):
+            self.room.handle_membership(nio.RoomMemberEvent.from_dict({
+                "content": {"membership": "join", "displayname": display_name},
+                "event_id": f"$join_{user_id}",
+                "origin_server_ts": 1516362319505,
+                "sender": user_id,
+                "state_key": user_id,
+                "type": "m.room.member"
+            }))
+
+    def test_matrix_nio_compact_room_members(self):
+        self.assertEqual(len(self.room.users), 3)
+        self.assertIn("@charles:colombay.fr", self.room.users)
+        self.assertNotIn("@francois:elysee.fr", self.room.users)
+        self.assertEqual(self.room.users["@charles:colombay.fr"].display_name, "Charles de Gaulle")
+        self.assertEqual(self.room.user_name("@georges:elysee.fr"), "Georges Pompidou")
+        self.assertEqual(sorted(user.display_name for user in self.room.users.values()),
+                         ["Charles de Gaulle", "Georges Pompidou", "Valéry Giscard d'Estaing"])
+
+    def test_matrix_nio_compact_room_bounded_cache(self):
+        self.assertLessEqual(len(self.room.users._cache), 2)
+        # Changes made to a member are kept once it has been evicted from the cache
+        self.room.users["@charles:colombay.fr"].power_level = 100
+        self.room.users["@georges:elysee.fr"]
+        self.room.users["@valery:elysee.fr"]
+        self.assertNotIn("@charles:colombay.fr", self.room.users._cache)
+        self.assertEqual(self.room.users["@charles:colombay.fr"].power_level, 100)
+
+    def test_matrix_nio_compact_room_name_clashes(self):
+        self.room.handle_membership(nio.RoomMemberEvent.from_dict({
+            "content": {"membership": "join", "displayname": "Charles de Gaulle"},
+            "event_id": "$join_impostor",
+            "origin_server_ts": 1516362319505,
+            "sender": "@impostor:example.org",
+            "state_key": "@impostor:example.org",
+            "type": "m.room.member"
+        }))
+        self.assertEqual(self.room.user_name("@impostor:example.org"), "Charles de Gaulle (@impostor:example.org)")
+        self.assertEqual(sorted(self.room.user_name_clashes("Charles de Gaulle")),
+                         ["@charles:colombay.fr", "@impostor:example.org"])
+
+    def test_matrix_nio_compact_room_leave(self):
+        self.room.handle_membership(nio.RoomMemberEvent.from_dict({
+            "content": {"membership": "leave"},
+            "event_id": "$leave",
+            "origin_server_ts": 1516362319505,
+            "sender": "@charles:colombay.fr",
+            "state_key": "@charles:colombay.fr",
+            "type": "m.room.member"
+        }))
+        self.assertEqual(len(self.room.users), 2)
+        self.assertNotIn("@charles:colombay.fr", self.room.users)
+        self.assertEqual(list(self.room.user_name_clashes("Charles de Gaulle")), [])
+
+    def test_matrix_nio_compact_room_occupants(self):
+        client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        client.rooms = {"test_room": self.room}
+        room = matrix_nio.MatrixNioRoom.from_matrix_room(self.room, client)
+        self.assertEqual(sorted(occupant.id for occupant in room.occupants),
+                         ["@charles:colombay.fr", "@georges:elysee.fr", "@valery:elysee.fr"])
+
+    def test_matrix_nio_member_database_batches_writes(self):
+        database = matrix_nio.MatrixNioMemberDatabase(":memory:")
+        statements = []
+        database._connection.set_trace_callback(lambda statement: statements.append(statement))
+        for index in range(1000):
+            database.put_member("test_room", MatrixUser(f"@user{index}:example.org", f"User {index}"))
+            database.add_name("test_room", f"User {index}", f"@user{index}:example.org")
+        # Nothing is written until a query needs it, buffered members are still found
+        self.assertEqual(statements, [])
+        self.assertEqual(database.get_member("test_room", "@user1:example.org")[:2], ("@user1:example.org", "User 1"))
+        self.assertEqual(database.count_members("test_room"), 1000)
+        self.assertEqual(database.get_name("test_room", "User 1"), ["@user1:example.org"])
+        self.assertEqual([statement for statement in statements if statement in ("BEGIN", "COMMIT")],
+                         ["BEGIN", "COMMIT"])
+
+    def test_matrix_nio_client_creates_compact_rooms(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org",
+                                            user="test_user",
+                                            device_id="test_device",
+                                            member_database=self.database)
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            response = SyncResponse.from_dict(json.loads(json_file.read()))
+        for room_id, join_info in response.rooms.join.items():
+            client._handle_joined_state(room_id, join_info, set())
+            self.assertIsInstance(client.rooms[room_id], matrix_nio.MatrixNioCompactRoom)
+
+
+class TestMatrixNioPowerLevels(TestCase):
+    def setUp(self) -> None:
+        self.power_levels = matrix_nio.MatrixNioPowerLevels.from_power_levels(
+            nio.PowerLevels(nio.DefaultLevels(users_default=10), {"@admin:example.org": 100, "@mod:example.org": 50})
+        )
+
+    def test_matrix_nio_power_levels_get(self):
+        self.assertEqual(self.power_levels.get("@admin:example.org"), 100)
+        self.assertEqual(self.power_levels.get("@mod:example.org"), 50)
+        self.assertEqual(self.power_levels.get("@user:example.org"), 10)
+
+    def test_matrix_nio_power_levels_update(self):
+        self.power_levels.update(
+            nio.PowerLevels(nio.DefaultLevels(users_default=0), {"@admin:example.org": 100, "@user:example.org": 50})
+        )
+        self.assertEqual(self.power_levels.get("@admin:example.org"), 100)
+        self.assertEqual(self.power_levels.get("@mod:example.org"), 0)
+        self.assertEqual(self.power_levels.get("@user:example.org"), 50)
+
 
 class TestMatrixNioRoomOccupant(TestCase):
     def setUp(self) -> None:
@@ -412,6 +568,397 @@ class TestMatrixNioRoomOccupant(TestCase):
         self.assertEqual(self.room_occupant1.room, room1)
 
 
+class TestMatrixNioEventDeduplicator(TestCase):
+    def test_matrix_nio_event_deduplicator_seen(self):
+        deduplicator = matrix_nio.MatrixNioEventDeduplicator()
+        self.assertFalse(deduplicator.seen("$event1"))
+        self.assertFalse(deduplicator.seen("$event2"))
+        self.assertTrue(deduplicator.seen("$event1"))
+        self.assertEqual(len(deduplicator), 2)
+
+    def test_matrix_nio_event_deduplicator_max_size(self):
+        deduplicator = matrix_nio.MatrixNioEventDeduplicator(max_size=2)
+        deduplicator.seen("$event1")
+        deduplicator.seen("$event2")
+        deduplicator.seen("$event3")
+        self.assertEqual(len(deduplicator), 2)
+        self.assertNotIn("$event1", deduplicator)
+        self.assertIn("$event3", deduplicator)
+
+    def test_matrix_nio_event_deduplicator_window(self):
+        deduplicator = matrix_nio.MatrixNioEventDeduplicator(window=60)
+        with mock.patch("matrix_nio.time.time", return_value=1000):
+            deduplicator.seen("$event1")
+        with mock.patch("matrix_nio.time.time", return_value=1100):
+            self.assertFalse(deduplicator.seen("$event1"))
+        self.assertEqual(len(deduplicator), 1)
+
+    def test_matrix_nio_event_deduplicator_persistence(self):
+        deduplicator = matrix_nio.MatrixNioEventDeduplicator()
+        deduplicator.seen("$event1")
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, "events.json")
+            deduplicator.save(path)
+            restored = matrix_nio.MatrixNioEventDeduplicator()
+            restored.load(path)
+        self.assertTrue(restored.seen("$event1"))
+        self.assertFalse(restored.seen("$event2"))
+
+
+class TestMatrixNioClient(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        with open(os.path.join(os.path.dirname(__file__), "sync.json"), "rb") as json_file:
+            self.body = json_file.read()
+        self.transport_response = mock.Mock()
+        self.transport_response.read = mock.Mock(return_value=aiounittest.futurized(self.body))
+
+    async def test_matrix_nio_client_parse_body(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        result = await client.parse_body(self.transport_response)
+        self.assertEqual(result, json.loads(self.body))
+
+    async def test_matrix_nio_client_parse_body_in_thread(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org",
+                                            user="test_user",
+                                            device_id="test_device",
+                                            json_thread_threshold=1024)
+        loop = asyncio.get_event_loop()
+        with mock.patch.object(loop, "run_in_executor", wraps=loop.run_in_executor) as run_in_executor:
+            result = await client.parse_body(self.transport_response)
+        run_in_executor.assert_called_once_with(None, matrix_nio.json_loads, self.body)
+        self.assertEqual(result, json.loads(self.body))
+
+    async def test_matrix_nio_client_single_flight(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        client.access_token = "test_token"
+        requests = []
+
+        async def send(response_class, method, path, *args, **kwargs):
+            requests.append(path)
+            await asyncio.sleep(0.01)
+            if response_class is nio.JoinedRoomsResponse:
+                return JoinedRoomsResponse.from_dict({"joined_rooms": ["test_room"]})
+            return nio.ProfileGetDisplayNameResponse.from_dict({"displayname": path})
+
+        client._send = send
+        results = await asyncio.gather(
+            client.get_displayname("@a:matrix.org"),
+            client.get_displayname("@a:matrix.org"),
+            client.get_displayname("@b:matrix.org"),
+            client.joined_rooms(),
+            client.joined_rooms()
+        )
+        self.assertEqual(len(requests), 3)
+        self.assertIs(results[0], results[1])
+        self.assertIsNot(results[0], results[2])
+        self.assertEqual(results[3].rooms, ["test_room"])
+        self.assertEqual(client._requests_in_flight, {})
+        # Once answered, a new call makes a new request
+        await client.get_displayname("@a:matrix.org")
+        self.assertEqual(len(requests), 4)
+        # Profiles are coalesced by build_identifier only
+        await asyncio.gather(client.get_profile("@a:matrix.org"), client.get_profile("@a:matrix.org"))
+        self.assertEqual(len(requests), 6)
+
+    async def test_matrix_nio_client_adaptive_sync_timeout(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        client.adaptive_timeout = matrix_nio.MatrixNioSyncTimeout(min_timeout=1000, max_timeout=30000)
+        active = nio.SyncResponse.from_dict(json.loads(self.body))
+        idle = copy.deepcopy(json.loads(self.body))
+        for room in idle["rooms"]["join"].values():
+            room["timeline"]["events"] = []
+        idle = nio.SyncResponse.from_dict(idle)
+        responses = iter([idle, active, idle, idle])
+        sync = mock.Mock(side_effect=lambda *args, **kwargs: aiounittest.futurized(next(responses)))
+        with mock.patch.object(nio.AsyncClient, "sync", sync):
+            # The first sync of sync_forever is not delayed
+            await client.sync(0)
+            await client.sync(30000)
+            await client.sync(30000)
+            await client.sync(30000)
+        self.assertEqual([args[0] for args, kwargs in sync.call_args_list], [0, 30000, 1000, 2000])
+        self.assertEqual(client.adaptive_timeout.timeout, 4000)
+
+    async def test_matrix_nio_client_parse_invalid_body(self):
+        client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        self.transport_response.read = mock.Mock(return_value=aiounittest.futurized(b"<html>Not JSON</html>"))
+        result = await client.parse_body(self.transport_response)
+        self.assertEqual(result, {})
+
+    async def test_matrix_nio_client_record_sync(self):
+        path = os.path.join(tempfile.mkdtemp(), "traffic.log.gz")
+        client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        client.recorder = matrix_nio.MatrixNioRecorder(path)
+        self.transport_response.url.path = "/_matrix/client/r0/sync"
+        await client.parse_body(self.transport_response)
+        self.transport_response.url.path = "/_matrix/client/r0/joined_rooms"
+        self.transport_response.read = mock.Mock(return_value=aiounittest.futurized(b'{"joined_rooms": []}'))
+        await client.parse_body(self.transport_response)
+        client.recorder.close()
+        records = list(matrix_nio.MatrixNioRecorder.read(path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["response"], json.loads(self.body))
+
+
+class TestMatrixNioProfiler(TestCase):
+    def test_matrix_nio_profiler_spans(self):
+        profiler = matrix_nio.MatrixNioProfiler()
+        for duration in (0.01, 0.03):
+            with profiler.span("dispatch"):
+                time.sleep(duration)
+        stats = profiler.stats()["dispatch"]
+        self.assertEqual(stats["count"], 2)
+        self.assertGreaterEqual(stats["total"], 0.04)
+        self.assertGreaterEqual(stats["max"], 0.03)
+        self.assertAlmostEqual(stats["average"], stats["total"] / 2)
+        profiler.reset()
+        self.assertEqual(profiler.stats(), {})
+
+    def test_matrix_nio_profiler_disabled(self):
+        profiler = matrix_nio.MatrixNioProfiler(enabled=False)
+        with profiler.span("dispatch"):
+            pass
+        self.assertEqual(profiler.stats(), {})
+
+    def test_matrix_nio_profiler_profile(self):
+        profiler = matrix_nio.MatrixNioProfiler()
+        path = os.path.join(tempfile.mkdtemp(), "test.prof")
+        with self.assertRaises(ValueError):
+            profiler.dump_profile(path)
+        profiler.start_profile()
+        self.assertTrue(profiler.profiling)
+        sorted(range(1000), key=str)
+        profiler.stop_profile()
+        profiler.dump_profile(path)
+        self.assertFalse(profiler.profiling)
+        functions = [function for _, _, function in pstats.Stats(path).stats]
+        self.assertIn("<built-in method builtins.sorted>", functions)
+
+
+class TestMatrixNioLoopWatchdog(aiounittest.AsyncTestCase):
+    def blocking_callback(self):
+        time.sleep(0.1)
+
+    async def test_matrix_nio_loop_watchdog(self):
+        watchdog = matrix_nio.MatrixNioLoopWatchdog(interval=0.005, threshold=0.05)
+        self.assertEqual(watchdog.percentiles(), {})
+        task = asyncio.ensure_future(watchdog.run())
+        await asyncio.sleep(0.05)
+        self.blocking_callback()
+        await asyncio.sleep(0.02)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        percentiles = watchdog.percentiles()
+        self.assertEqual(list(percentiles), ["p50", "p90", "p99", "max"])
+        self.assertGreaterEqual(percentiles["max"], 0.09)
+        self.assertLess(percentiles["p50"], 0.05)
+        self.assertEqual(len(watchdog.stalls), 1)
+        self.assertIn("blocking_callback", watchdog.stalls[0]["stack"])
+
+
+class TestMatrixNioMediaCache(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.downloads = []
+
+    def downloader(self, content: bytes):
+        async def download(path):
+            self.downloads.append(path)
+            await asyncio.sleep(0.01)
+            with open(path, "wb") as media_file:
+                media_file.write(content)
+        return download
+
+    async def test_matrix_nio_media_cache(self):
+        cache = matrix_nio.MatrixNioMediaCache(self.directory)
+        paths = await asyncio.gather(
+            cache.fetch("mxc://matrix.org/a", self.downloader(b"content")),
+            cache.fetch("mxc://matrix.org/a", self.downloader(b"content"))
+        )
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(len(self.downloads), 1)
+        with open(paths[0], "rb") as media_file:
+            self.assertEqual(media_file.read(), b"content")
+        self.assertEqual(await cache.fetch("mxc://matrix.org/a", self.downloader(b"content")), paths[0])
+        self.assertEqual(len(self.downloads), 1)
+        # Same content behind another URL is stored once
+        self.assertEqual(await cache.fetch("mxc://matrix.org/b", self.downloader(b"content")), paths[0])
+        self.assertEqual(len(self.downloads), 2)
+        self.assertEqual(len(cache), 1)
+        # Reloaded from disk
+        cache = matrix_nio.MatrixNioMediaCache(self.directory)
+        self.assertEqual(await cache.fetch("mxc://matrix.org/b", self.downloader(b"content")), paths[0])
+        self.assertEqual(len(self.downloads), 2)
+
+    async def test_matrix_nio_media_cache_eviction(self):
+        cache = matrix_nio.MatrixNioMediaCache(self.directory, max_size=10)
+        first = await cache.fetch("mxc://matrix.org/a", self.downloader(b"aaaa"))
+        await cache.fetch("mxc://matrix.org/b", self.downloader(b"bbbb"))
+        await cache.fetch("mxc://matrix.org/a", self.downloader(b"aaaa"))
+        await cache.fetch("mxc://matrix.org/c", self.downloader(b"cccc"))
+        # b was the least recently used
+        self.assertEqual(cache.size, 8)
+        self.assertTrue(os.path.exists(first))
+        await cache.fetch("mxc://matrix.org/b", self.downloader(b"bbbb"))
+        self.assertEqual(len(self.downloads), 4)
+
+    async def test_matrix_nio_media_cache_error(self):
+        cache = matrix_nio.MatrixNioMediaCache(self.directory)
+
+        async def failing_download(path):
+            with open(path, "wb") as media_file:
+                media_file.write(b"partial")
+            raise ValueError("Download failed")
+
+        with self.assertRaises(ValueError):
+            await cache.fetch("mxc://matrix.org/a", failing_download)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestMatrixNioSyncTimeout(TestCase):
+    def test_matrix_nio_sync_timeout(self):
+        sync_timeout = matrix_nio.MatrixNioSyncTimeout(min_timeout=500, max_timeout=4000)
+        self.assertEqual(sync_timeout.timeout, 4000)
+        sync_timeout.update(True)
+        self.assertEqual(sync_timeout.timeout, 500)
+        timeouts = []
+        for _ in range(5):
+            sync_timeout.update(False)
+            timeouts.append(sync_timeout.timeout)
+        self.assertEqual(timeouts, [1000, 2000, 4000, 4000, 4000])
+
+
+class TestMatrixNioRecorder(TestCase):
+    def test_matrix_nio_recorder(self):
+        path = os.path.join(tempfile.mkdtemp(), "traffic.log.gz")
+        recorder = matrix_nio.MatrixNioRecorder(path)
+        recorder.record("sync", response={"next_batch": "batch_1"})
+        recorder.close()
+        # Appending again keeps the previous records
+        recorder = matrix_nio.MatrixNioRecorder(path)
+        recorder.record("send", room_id="test_room", content={"body": "Hello"})
+        recorder.close()
+        records = list(matrix_nio.MatrixNioRecorder.read(path))
+        self.assertEqual([record["type"] for record in records], ["sync", "send"])
+        self.assertEqual(records[0]["response"], {"next_batch": "batch_1"})
+        self.assertEqual(records[1]["content"], {"body": "Hello"})
+        self.assertLessEqual(records[0]["time"], records[1]["time"])
+
+    def test_matrix_nio_recorder_killed(self):
+        path = os.path.join(tempfile.mkdtemp(), "traffic.log.gz")
+        recorder = matrix_nio.MatrixNioRecorder(path)
+        recorder.record("sync", response={"next_batch": "batch_1"})
+        recorder.flush()
+        recorder.record("sync", response={"next_batch": "batch_2"})
+        recorder.flush()
+        # Killed while writing the third flush, without closing the log
+        recorder.record("sync", response={"next_batch": "batch_3"})
+        recorder.flush()
+        with open(path, "rb") as log_file:
+            data = log_file.read()
+        with open(path, "wb") as log_file:
+            log_file.write(data[:-10])
+        records = list(matrix_nio.MatrixNioRecorder.read(path))
+        self.assertEqual([record["response"]["next_batch"] for record in records], ["batch_1", "batch_2"])
+
+
+class TestMatrixNioAliasCache(TestCase):
+    def test_matrix_nio_alias_cache(self):
+        aliases = matrix_nio.MatrixNioAliasCache()
+        aliases.put("#ops:example.org", "!ops:example.org")
+        self.assertEqual(aliases.get("#ops:example.org"), "!ops:example.org")
+        self.assertIsNone(aliases.get("#dev:example.org"))
+
+    def test_matrix_nio_alias_cache_lru(self):
+        aliases = matrix_nio.MatrixNioAliasCache(max_size=2)
+        aliases.put("#ops:example.org", "!ops:example.org")
+        aliases.put("#dev:example.org", "!dev:example.org")
+        aliases.get("#ops:example.org")
+        aliases.put("#qa:example.org", "!qa:example.org")
+        self.assertEqual(len(aliases), 2)
+        self.assertEqual(aliases.get("#ops:example.org"), "!ops:example.org")
+        self.assertIsNone(aliases.get("#dev:example.org"))
+
+    def test_matrix_nio_alias_cache_ttl(self):
+        aliases = matrix_nio.MatrixNioAliasCache(ttl=60)
+        with mock.patch("matrix_nio.time.monotonic", return_value=1000):
+            aliases.put("#ops:example.org", "!ops:example.org")
+        with mock.patch("matrix_nio.time.monotonic", return_value=1100):
+            self.assertIsNone(aliases.get("#ops:example.org"))
+        self.assertEqual(len(aliases), 0)
+
+
+class TestMatrixNioSendScheduler(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.sent = []
+
+    def send(self, room_id: str, index: int):
+        async def send():
+            self.sent.append((room_id, index))
+            await asyncio.sleep(0)
+            return index
+        return send
+
+    async def test_matrix_nio_send_scheduler_fairness(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=1000, burst=1000)
+        sends = [scheduler.submit("noisy_room", self.send("noisy_room", index)) for index in range(5)]
+        sends.append(scheduler.submit("quiet_room", self.send("quiet_room", 0)))
+        results = await asyncio.gather(*sends)
+        self.assertEqual(results, [0, 1, 2, 3, 4, 0])
+        # The quiet room does not wait for the noisy room's backlog
+        self.assertLess(self.sent.index(("quiet_room", 0)), 2)
+        self.assertEqual([index for room_id, index in self.sent if room_id == "noisy_room"], [0, 1, 2, 3, 4])
+        self.assertEqual(scheduler.stats()["noisy_room"]["sent"], 5)
+        self.assertEqual(scheduler.stats()["quiet_room"]["sent"], 1)
+
+    async def test_matrix_nio_send_scheduler_priority(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=1000, burst=1000, concurrency=1)
+        sends = [scheduler.submit("noisy_room", self.send("noisy_room", index)) for index in range(5)]
+        sends.append(scheduler.submit("admin_room", self.send("admin_room", 0), priority=True))
+        await asyncio.gather(*sends)
+        self.assertLess(self.sent.index(("admin_room", 0)), 2)
+
+    async def test_matrix_nio_send_scheduler_priority_order(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=1000, burst=1000, concurrency=1)
+        sends = [scheduler.submit("noisy_room", self.send("noisy_room", index)) for index in range(3)]
+        sends.append(scheduler.submit("admin_room", self.send("admin_room", 0)))
+        sends.extend(scheduler.submit("admin_room", self.send("admin_room", index), priority=True)
+                     for index in (1, 2, 3))
+        await asyncio.gather(*sends)
+        # Priority picks the room that goes next, the room's messages stay in order
+        self.assertEqual(self.sent, [("admin_room", 0), ("admin_room", 1), ("admin_room", 2), ("admin_room", 3),
+                                     ("noisy_room", 0), ("noisy_room", 1), ("noisy_room", 2)])
+        self.assertEqual(scheduler.pending(), 0)
+
+    async def test_matrix_nio_send_scheduler_rate(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=100, burst=1)
+        start = time.monotonic()
+        await asyncio.gather(*(scheduler.submit(f"room{index}", self.send(f"room{index}", index))
+                               for index in range(5)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertEqual(len(self.sent), 5)
+
+    async def test_matrix_nio_send_scheduler_error(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=1000)
+
+        async def failing_send():
+            raise ValueError("Send error")
+
+        with self.assertRaises(ValueError):
+            await scheduler.submit("test_room", failing_send)
+
+    async def test_matrix_nio_send_scheduler_cancelled(self):
+        scheduler = matrix_nio.MatrixNioSendScheduler(rate=1000, concurrency=1)
+        first = asyncio.ensure_future(scheduler.submit("room1", self.send("room1", 0)))
+        given_up = asyncio.ensure_future(scheduler.submit("room2", self.send("room2", 0)))
+        await asyncio.sleep(0)
+        given_up.cancel()
+        self.assertEqual(await first, 0)
+        await asyncio.sleep(0.01)
+        # Never sent
+        self.assertEqual(self.sent, [("room1", 0)])
+
+
 class TestMatrixNioBackend(aiounittest.AsyncTestCase):
     def setUp(self) -> None:
         class Configuration(object):
@@ -473,6 +1020,17 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         backend.serve_once()
         sync_forever_mock.assert_called_once_with(30000, full_state=True)
 
+    def test_matrix_nio_backend_serve_once_sync_options(self):
+        self.bot_config.MATRIX_NIO_SYNC_TIMEOUT = 60000
+        self.bot_config.MATRIX_NIO_SYNC_PRESENCE = "offline"
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.has_synced = True
+        backend.client.access_token = True
+        backend.client.sync_forever = mock.Mock(return_value=aiounittest.futurized(True))
+        backend.serve_once()
+        backend.client.sync_forever.assert_called_once_with(60000, full_state=True, set_presence="offline")
+
     def test_matrix_nio_backend_serve_once_logged_in_has_not_synced(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
@@ -493,6 +1051,119 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         self.assertEqual(backend.client.next_batch, data["next_batch"])
         sync_mock.assert_called_once_with(full_state=True)
 
+    def test_matrix_nio_backend_serve_once_catch_up(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            self.bot_config.BOT_DATA_DIR = data_dir
+            self.bot_config.MATRIX_NIO_CATCH_UP = True
+            with open(os.path.join(data_dir, "matrix_nio_sync.json"), "w") as sync_file:
+                json.dump({"next_batch": "previous_batch"}, sync_file)
+            backend = matrix_nio.MatrixNioBackend(self.bot_config)
+            backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+            # Needed for ensuring that backend.client.logged_in = True
+            backend.client.access_token = True
+            with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+                data = json.loads(json_file.read())
+            room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+            backend.client.rooms = {room_id: MatrixRoom(room_id, "test_user")}
+            backend.client.sync = mock.Mock(
+                return_value=aiounittest.futurized(
+                    SyncResponse.from_dict(data)
+                )
+            )
+            backend.client.room_messages = mock.Mock(
+                side_effect=lambda room_id, **kwargs: aiounittest.futurized(
+                    nio.RoomMessagesResponse.from_dict({"chunk": [], "start": kwargs["start"]}, room_id)
+                )
+            )
+            backend.handle_message = mock.Mock()
+            # The message in sync.json is too old to be processed
+            backend.serve_once()
+            backend.client.sync.assert_called_once_with(full_state=True, since="previous_batch")
+            backend.handle_message.assert_not_called()
+
+            backend.has_synced = False
+            backend.catch_up_max_age = float("inf")
+            backend.serve_once()
+            backend.handle_message.assert_called_once()
+            self.assertEqual(backend.handle_message.call_args[0][0].room_id, room_id)
+
+            backend._save_state()
+            with open(os.path.join(data_dir, "matrix_nio_sync.json")) as sync_file:
+                self.assertEqual(json.load(sync_file), {"next_batch": data["next_batch"]})
+
+    async def test_matrix_nio_backend_catch_up_limited_timeline(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_CATCH_UP = True
+        self.bot_config.MATRIX_NIO_CATCH_UP_MAX_AGE = float("inf")
+        self.bot_config.MATRIX_NIO_CATCH_UP_BATCH_SIZE = 2
+        self.bot_config.MATRIX_NIO_CATCH_UP_BATCH_DELAY = 0
+        self.bot_config.MATRIX_NIO_PIPELINE = True
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            data = json.loads(json_file.read())
+        room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+        backend.client.rooms = {room_id: MatrixRoom(room_id, "test_user")}
+
+        def message(index):
+            return {
+                "content": {"msgtype": "m.text", "body": f"missed {index}"},
+                "event_id": f"$missed{index}",
+                "origin_server_ts": 1520372800000 + index,
+                "sender": "@example:localhost",
+                "type": "m.room.message"
+            }
+
+        # The gap left by the limited timeline, newest first
+        pages = {
+            data["rooms"]["join"][room_id]["timeline"]["prev_batch"]: ([message(3), message(2)], "page_2"),
+            "page_2": ([message(1)], "page_3"),
+            "page_3": ([], None)
+        }
+        backend.client.room_messages = mock.Mock(
+            side_effect=lambda room_id, start, end, limit: aiounittest.futurized(
+                nio.RoomMessagesResponse.from_dict({"chunk": pages[start][0], "start": start, "end": pages[start][1]},
+                                                   room_id)
+            )
+        )
+        dispatched = []
+        backend.handle_message = lambda room, event: dispatched.append(event.body)
+        await backend._catch_up(SyncResponse.from_dict(data), "previous_batch")
+        await backend._stop_background_tasks()
+        # Every missed message went through the dispatch queue, oldest first
+        self.assertEqual(dispatched, ["missed 1", "missed 2", "missed 3", "baba"])
+        self.assertEqual([call[1]["start"] for call in backend.client.room_messages.call_args_list],
+                         [data["rooms"]["join"][room_id]["timeline"]["prev_batch"], "page_2", "page_3"])
+        self.assertEqual({call[1]["end"] for call in backend.client.room_messages.call_args_list}, {"previous_batch"})
+
+    async def test_matrix_nio_backend_catch_up_saves_processed_events(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_CATCH_UP = True
+        self.bot_config.MATRIX_NIO_CATCH_UP_MAX_AGE = float("inf")
+        self.bot_config.MATRIX_NIO_CATCH_UP_BATCH_SIZE = 1
+        self.bot_config.MATRIX_NIO_CATCH_UP_BATCH_DELAY = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            data = json.loads(json_file.read())
+        room_id = "!SVkFJHzfwvuaIEawgC:localhost"
+        backend.client.rooms = {room_id: MatrixRoom(room_id, "test_user")}
+        backend.client.room_messages = mock.Mock(
+            side_effect=lambda room_id, **kwargs: aiounittest.futurized(
+                nio.RoomMessagesResponse.from_dict({"chunk": [], "start": kwargs["start"]}, room_id)
+            )
+        )
+        backend.callback_message = mock.Mock()
+        await backend._catch_up(SyncResponse.from_dict(data), "previous_batch")
+        backend.callback_message.assert_called_once()
+        # After a crash, the messages already processed while catching up are skipped
+        restarted = matrix_nio.MatrixNioBackend(self.bot_config)
+        restarted.client = backend.client
+        restarted.callback_message = mock.Mock()
+        await restarted._catch_up(SyncResponse.from_dict(data), "previous_batch")
+        restarted.callback_message.assert_not_called()
+
     def test_matrix_nio_backend_serve_once_logged_keyboard_interrupt(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
@@ -509,11 +1180,75 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
                 True
             )
         )
+        backend.client.close = mock.Mock(
+            return_value=aiounittest.futurized(
+                None
+            )
+        )
         backend.client.sync_forever = sync_forever_mock
-        backend.serve_once()
+        self.assertTrue(backend.serve_once())
         sync_forever_mock.assert_called_once_with(30000, full_state=True)
+        # The device is kept for the next start
+        backend.client.logout.assert_not_called()
+        backend.client.close.assert_called_once()
+
+    def test_matrix_nio_backend_serve_once_logged_keyboard_interrupt_logout(self):
+        self.bot_config.MATRIX_NIO_LOGOUT_ON_SHUTDOWN = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.has_synced = True
+        # Needed for ensuring that backend.client.logged_in = True
+        backend.client.access_token = True
+        backend.client.sync_forever = mock.Mock(side_effect=KeyboardInterrupt())
+        backend.client.logout = mock.Mock(return_value=aiounittest.futurized(True))
+        self.assertTrue(backend.serve_once())
         backend.client.logout.assert_called_once()
 
+    async def test_matrix_nio_backend_shutdown_drains_sends(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        sent = []
+
+        async def room_send(room_id, message_type, content):
+            await asyncio.sleep(0.01)
+            sent.append(content["body"])
+            return RoomSendResponse.from_dict({"event_id": "$event"}, room_id)
+
+        backend.client.room_send = room_send
+        backend.client.logout = mock.Mock(return_value=aiounittest.futurized(True))
+        sends = [asyncio.ensure_future(backend._room_send("test_room", {"body": f"Message {index}"}))
+                 for index in range(3)]
+        await asyncio.sleep(0)
+        await backend._shutdown()
+        self.assertEqual(sorted(sent), ["Message 0", "Message 1", "Message 2"])
+        self.assertFalse(backend.accepting_messages)
+        backend.client.logout.assert_not_called()
+        await asyncio.gather(*sends)
+
+    async def test_matrix_nio_backend_shutdown_keeps_unprocessed_sync(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_CATCH_UP = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_read_markers = mock.Mock(
+            side_effect=lambda room_id, **kwargs: aiounittest.futurized(nio.responses.RoomReadMarkersResponse(room_id))
+        )
+        backend.callback_message = mock.Mock()
+        backend._add_callbacks()
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            data = json.loads(json_file.read())
+        processed = SyncResponse.from_dict(dict(data, next_batch="batch_1"))
+        await backend.client.receive_response(processed)
+        await backend.client.run_response_callbacks([processed])
+        await backend._shutdown()
+        # The sync in flight when shutting down completes, its messages are dropped
+        in_flight = SyncResponse.from_dict(dict(data, next_batch="batch_2"))
+        await backend.client.receive_response(in_flight)
+        await backend.client.run_response_callbacks([in_flight])
+        backend._save_state()
+        with open(os.path.join(self.bot_config.BOT_DATA_DIR, "matrix_nio_sync.json")) as sync_file:
+            self.assertEqual(json.load(sync_file), {"next_batch": "batch_1"})
+
     def test_matrix_nio_backend_serve_once_not_logged_in_has_synced(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
@@ -550,6 +1285,29 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         backend.client.get_profile.assert_called_once_with(user_id)
         login_response_mock.assert_called_once_with(self.bot_config.BOT_IDENTITY["auth_dict"])
 
+    def test_matrix_nio_backend_serve_once_event_loop(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend._serve_once = mock.Mock(side_effect=lambda: aiounittest.futurized(False))
+        backend.serve_once()
+        loop = backend.loop
+        self.assertIs(asyncio.get_event_loop(), loop)
+        # Reconnections keep the same loop
+        backend.serve_once()
+        self.assertIs(backend.loop, loop)
+
+    def test_matrix_nio_backend_serve_once_uvloop(self):
+        uvloop = pytest.importorskip("uvloop")
+        self.bot_config.MATRIX_NIO_EVENT_LOOP = "uvloop"
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend._serve_once = mock.Mock(side_effect=lambda: aiounittest.futurized(False))
+        backend.serve_once()
+        self.assertIsInstance(backend.loop, uvloop.Loop)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def test_matrix_nio_backend_unknown_event_loop(self):
+        with self.assertRaises(ValueError):
+            matrix_nio._new_event_loop("twisted")
+
     def test_matrix_nio_backend_serve_once_login_error(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
@@ -633,6 +1391,446 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         callback.assert_called_once()
         backend.build_message.assert_called_once_with(test_message.body)
 
+    def test_matrix_nio_backend_handle_duplicate_message(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org",
+                                         user="test_user",
+                                         device_id="test_device"
+                                         )
+        backend.client.rooms = {"test_room": "Test Room"}
+        test_message = RoomMessageText.from_dict({
+            "content": {
+                "body": "Test message",
+                "msgtype": "m.text"
+            },
+            "event_id": "$15163623196QOZxj:localhost",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "type": "m.room.message"
+        })
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        backend.callback_message = mock.Mock()
+        backend.handle_message(test_room, test_message)
+        backend.handle_message(test_room, test_message)
+        backend.callback_message.assert_called_once()
+
+    async def test_matrix_nio_backend_pipeline(self):
+        self.bot_config.MATRIX_NIO_PIPELINE = True
+        self.bot_config.MATRIX_NIO_PIPELINE_QUEUE_SIZE = 2
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        dispatched = []
+        plugins_ready = threading.Event()
+
+        def handle_message(room, event):
+            plugins_ready.wait()
+            dispatched.append(event)
+
+        backend.handle_message = handle_message
+        backend._start_background_tasks()
+        # One message being dispatched, two waiting in the queue
+        for index in range(3):
+            await backend._enqueue_message(test_room, index)
+        await asyncio.sleep(0.01)
+        # Plugins are behind, the sync loop is paused
+        blocked_enqueue = asyncio.ensure_future(backend._enqueue_message(test_room, 3))
+        await asyncio.sleep(0.01)
+        self.assertFalse(blocked_enqueue.done())
+        plugins_ready.set()
+        await blocked_enqueue
+        await backend._dispatch_queue.join()
+        self.assertEqual(dispatched, [0, 1, 2, 3])
+        await backend._stop_background_tasks()
+
+    async def test_matrix_nio_backend_pipeline_sync_token(self):
+        self.bot_config.MATRIX_NIO_PIPELINE = True
+        self.bot_config.MATRIX_NIO_CATCH_UP = True
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        plugins_ready = threading.Event()
+        backend.handle_message = lambda room, event: plugins_ready.wait()
+        backend._start_background_tasks()
+        await backend._enqueue_message(test_room, 0)
+        await backend.handle_sync(mock.Mock(next_batch="batch_1"))
+        await asyncio.sleep(0.01)
+        # Queued but not dispatched yet: saving the token would skip the message after a crash
+        backend._save_state()
+        self.assertFalse(os.path.exists(os.path.join(self.bot_config.BOT_DATA_DIR, "matrix_nio_sync.json")))
+        plugins_ready.set()
+        await backend._dispatch_queue.join()
+        await backend._stop_background_tasks()
+        with open(os.path.join(self.bot_config.BOT_DATA_DIR, "matrix_nio_sync.json")) as sync_file:
+            self.assertEqual(json.load(sync_file), {"next_batch": "batch_1"})
+
+    async def test_matrix_nio_backend_pipeline_reconnect(self):
+        self.bot_config.MATRIX_NIO_PIPELINE = True
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        dispatched = []
+        plugins_ready = threading.Event()
+
+        def handle_message(room, event):
+            plugins_ready.wait()
+            dispatched.append(event)
+
+        backend.handle_message = handle_message
+        backend._start_background_tasks()
+        for index in range(4):
+            await backend._enqueue_message(test_room, index)
+        await asyncio.sleep(0.01)
+        # The connection drops while messages are still queued
+        await backend._stop_background_tasks()
+        backend._start_background_tasks()
+        plugins_ready.set()
+        await backend._dispatch_queue.join()
+        self.assertEqual(dispatched, [0, 1, 2, 3])
+        await backend._stop_background_tasks()
+
+    async def test_matrix_nio_backend_leader_worker(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        self.bot_config.MATRIX_NIO_TYPING_NOTIFICATIONS = True
+        self.bot_config.MATRIX_NIO_EDIT_INTERVAL = 0
+        self.bot_config.MATRIX_NIO_ROLE = "leader"
+        leader = matrix_nio.MatrixNioBackend(self.bot_config)
+        leader.loop = asyncio.get_event_loop()
+        leader.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        leader.bot_identifier = matrix_nio.MatrixNioPerson("test_user", client=leader.client, full_name="Test Bot")
+        room_sends = []
+
+        async def room_send(room_id, content, priority=False):
+            room_sends.append((room_id, content, priority))
+            return nio.RoomSendResponse.from_dict({"event_id": f"test_event{len(room_sends)}"}, room_id)
+
+        leader._room_send = room_send
+        leader.client.room_typing = mock.Mock(
+            side_effect=lambda *args, **kwargs: aiounittest.futurized(nio.responses.RoomTypingResponse("test_room"))
+        )
+        leader.client.set_presence = mock.Mock(
+            side_effect=lambda *args: aiounittest.futurized(nio.responses.PresenceSetResponse())
+        )
+        leader.direct_rooms["@someone:matrix.org"] = "direct_room"
+        self.bot_config.MATRIX_NIO_ROLE = "worker"
+        worker = matrix_nio.MatrixNioBackend(self.bot_config)
+        worker.loop = asyncio.get_event_loop()
+        worker.connect_callback = mock.Mock()
+        received = []
+        worker.callback_message = received.append
+        leader._start_background_tasks()
+        await asyncio.sleep(0.01)
+        serving = asyncio.ensure_future(worker._serve_worker())
+        while not leader._workers:
+            await asyncio.sleep(0.01)
+        self.assertEqual(worker.bot_identifier.id, "test_user")
+        worker.connect_callback.assert_called_once()
+
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        leader.client.rooms["test_room"] = test_room
+        event = nio.RoomMessageText.from_dict({
+            "content": {"msgtype": "m.text", "body": "BotPrefixhelp"},
+            "event_id": "test_message",
+            "origin_server_ts": int(time.time() * 1000),
+            "sender": "@someone:matrix.org",
+            "type": "m.room.message"
+        })
+        leader.callback_message = mock.Mock()
+        leader.handle_message(test_room, event)
+        while not received:
+            await asyncio.sleep(0.01)
+        leader.callback_message.assert_not_called()
+        self.assertEqual(received[0].body, "BotPrefixhelp")
+        self.assertEqual(received[0].frm.id, "@someone:matrix.org")
+        self.assertEqual(received[0].to.id, "test_room")
+
+        reply = worker.build_reply(received[0], "Hello")
+        result = await worker._send_message(reply)
+        self.assertEqual(result.event_id, "test_event1")
+        self.assertEqual(room_sends, [("test_room", {"msgtype": "m.text", "body": reply.body}, False)])
+        # The leader stops typing once the worker replied
+        self.assertEqual(leader.client.room_typing.call_args_list, [
+            call("test_room", True, timeout=30000),
+            call("test_room", False, timeout=30000)
+        ])
+
+        # Edits, broadcasts and presence changes also go through the leader's client
+        editable = worker.send_editable_message(worker.build_reply(received[0], "Progress: 0%"))
+        self.assertEqual(await editable.event_id(), "test_event2")
+        editable.update("Progress: 100%")
+        await asyncio.sleep(0.01)
+        await editable.flush()
+        self.assertEqual(room_sends[-1][0], "test_room")
+        self.assertEqual(room_sends[-1][1]["m.relates_to"], {"rel_type": "m.replace", "event_id": "test_event2"})
+
+        person = matrix_nio.MatrixNioPerson("@someone:matrix.org", client=worker.client, full_name="Someone")
+        outcomes = await worker.broadcast("Hello all", ["other_room", person])
+        self.assertEqual({room_id: outcome.room_id for room_id, outcome in outcomes.items()},
+                         {"other_room": "other_room", "direct_room": "direct_room"})
+
+        worker.change_presence(matrix_nio.AWAY, "Busy")
+        while not leader.client.set_presence.called:
+            await asyncio.sleep(0.01)
+        leader.client.set_presence.assert_called_once_with("unavailable", "Busy")
+
+        leader._read_markers.clear()
+        await leader._stop_background_tasks()
+        self.assertFalse(await serving)
+
+    def test_matrix_nio_backend_worker_leaves_leader_state(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_ROLE = "worker"
+        self.bot_config.MATRIX_NIO_COMPACT_ROOMS = True
+        self.bot_config.MATRIX_NIO_RECORD = "traffic.log.gz"
+        self.bot_config.MATRIX_NIO_CATCH_UP = True
+        worker = matrix_nio.MatrixNioBackend(self.bot_config)
+        # The member store, traffic log and saved state in BOT_DATA_DIR are the leader's
+        self.assertIsNone(worker.client.member_database)
+        self.assertIsNone(worker.recorder)
+        worker._save_state()
+        self.assertEqual(os.listdir(self.bot_config.BOT_DATA_DIR), [])
+
+    async def test_matrix_nio_backend_leader_waits_for_workers(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_ROLE = "leader"
+        leader = matrix_nio.MatrixNioBackend(self.bot_config)
+        caught_up = asyncio.Event()
+        worker = mock.Mock()
+        worker.transport.is_closing.return_value = False
+
+        async def drain():
+            await caught_up.wait()
+
+        worker.drain = drain
+        leader._workers = [worker]
+        # The sync loop waits while the messages forwarded to the worker are unread
+        waiting = asyncio.ensure_future(leader._wait_for_workers(nio.MatrixRoom("test_room", "test_user"), None))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        caught_up.set()
+        await waiting
+
+    async def test_matrix_nio_backend_replay(self):
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            first_sync = json.load(json_file)
+        room_id = next(iter(first_sync["rooms"]["join"]))
+        second_sync = copy.deepcopy(first_sync)
+        second_sync["next_batch"] = "batch_2"
+        second_sync["rooms"]["join"][room_id]["state"]["events"] = []
+        second_sync["rooms"]["join"][room_id]["timeline"]["events"][0]["event_id"] = "$ping"
+        second_sync["rooms"]["join"][room_id]["timeline"]["events"][0]["content"] = {
+            "msgtype": "m.text",
+            "body": "ping"
+        }
+        path = os.path.join(tempfile.mkdtemp(), "traffic.log.gz")
+        recorder = matrix_nio.MatrixNioRecorder(path)
+        recorder.record("sync", response=first_sync)
+        recorder.record("send", room_id=room_id, content={"msgtype": "m.text", "body": "recorded"})
+        recorder.record("sync", response=second_sync)
+        recorder.close()
+
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="@test:localhost", device_id="test_device")
+        received = []
+
+        def callback_message(message):
+            received.append(message.body)
+            backend.send_message(matrix_nio.Message("pong", to=message.to))
+
+        backend.callback_message = callback_message
+        live_room_send = backend.client.room_send
+        with mock.patch.object(matrix_nio.ErrBot, "send_message"):
+            sent = await backend.replay(path, speed=None)
+        # Only the messages received after the first sync are dispatched
+        self.assertEqual(received, ["ping"])
+        self.assertEqual(sent, [{"room_id": room_id, "content": {"msgtype": "m.text", "body": "pong"}}])
+        # The live client sends to Matrix again
+        self.assertEqual(backend.client.room_send, live_room_send)
+
+    def test_matrix_nio_backend_profile_command(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_PROFILING = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        command = backend.commands["matrix_profile"]
+        self.assertTrue(command._err_command_admin_only)
+        backend.profiler.add("dispatch", 0.002)
+        self.assertIn("| dispatch | 1 | 0.002 | 2.00 | 2.00 |", command(None, ""))
+        self.assertEqual(command(None, "stop"), "Not profiling")
+        self.assertEqual(command(None, "start"), "Profiling started")
+        self.assertEqual(command(None, "start"), "Already profiling")
+        result = command(None, "stop")
+        path = result[len("Saving the profile to "):]
+        self.assertEqual(os.path.dirname(path), self.bot_config.BOT_DATA_DIR)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(command(None, "reset"), "Timings reset")
+        self.assertEqual(backend.profiler.stats(), {})
+
+    async def test_matrix_nio_backend_profile_command_on_loop(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_PROFILING = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.loop = asyncio.get_event_loop()
+        command = backend.commands["matrix_profile"]
+        # Commands run on the loop thread without the pipeline, they must not wait for it
+        self.assertEqual(command(None, "start"), "Profiling started")
+        await asyncio.sleep(0)
+        self.assertTrue(backend.profiler.profiling)
+        path = command(None, "stop")[len("Saving the profile to "):]
+        self.assertFalse(os.path.exists(path))
+        await asyncio.sleep(0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_matrix_nio_backend_commands_help(self):
+        self.bot_config.MATRIX_NIO_PROFILING = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        # The help command describes each command class with its __errdoc__
+        command = backend.commands["matrix_profile"]
+        cls = backend.get_plugin_class_from_method(command)
+        self.assertEqual(cls.__errdoc__.strip(), "Diagnostics of the Matrix Nio backend")
+
+    def test_matrix_nio_backend_delivery_latency(self):
+        self.bot_config.MATRIX_NIO_PROFILING = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        backend.client.rooms = {"test_room": test_room}
+        backend.callback_message = mock.Mock()
+        backend.handle_message(test_room, nio.RoomMessageText.from_dict({
+            "content": {"msgtype": "m.text", "body": "Hello"},
+            "event_id": "$latency",
+            "origin_server_ts": int(time.time() * 1000) - 1500,
+            "sender": "@example:localhost",
+            "type": "m.room.message"
+        }))
+        delivery = backend.profiler.stats()["delivery"]
+        self.assertEqual(delivery["count"], 1)
+        self.assertGreaterEqual(delivery["total"], 1.5)
+
+    def test_matrix_nio_backend_profiling_disabled(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        self.assertNotIn("matrix_profile", backend.commands)
+
+    def test_matrix_nio_backend_lag_command(self):
+        self.bot_config.MATRIX_NIO_LOOP_WATCHDOG = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        command = backend.commands["matrix_lag"]
+        self.assertTrue(command._err_command_admin_only)
+        self.assertEqual(command(None, ""), "No lag measured yet")
+        backend.watchdog._lags.extend([0.001, 0.002])
+        self.assertEqual(command(None, ""), "p50: 2.0 ms, p90: 2.0 ms, p99: 2.0 ms, max: 2.0 ms")
+        backend.watchdog.stalls.append({"time": time.time(), "blocked": 1.5, "stack": "  File \"plugin.py\"\n"})
+        self.assertIn("blocked the loop for 1.500s", command(None, ""))
+        self.assertIn("plugin.py", command(None, ""))
+        self.assertEqual(backend.commands["matrix_profile"](None, ""),
+                         "Profiling is disabled, set MATRIX_NIO_PROFILING to enable it")
+
+    async def test_matrix_nio_backend_handle_attachment(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_ATTACHMENTS = True
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        backend.client.rooms = {"test_room": test_room}
+        event = nio.RoomMessageFile.from_dict({
+            "content": {
+                "body": "report.pdf",
+                "msgtype": "m.file",
+                "url": "mxc://matrix.org/report",
+                "info": {"mimetype": "application/pdf", "size": 6}
+            },
+            "event_id": "$attachment",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "type": "m.room.message"
+        })
+        received = []
+        backend.callback_message = received.append
+        backend.handle_message(test_room, event)
+        attachment = received[0].extras["attachment"]
+        self.assertEqual(received[0].body, "report.pdf")
+        self.assertEqual((attachment.url, attachment.name, attachment.mimetype, attachment.size),
+                         ("mxc://matrix.org/report", "report.pdf", "application/pdf", 6))
+
+        async def download(mxc, save_to):
+            with open(save_to, "wb") as media_file:
+                media_file.write(b"%PDF-1")
+            return mock.Mock()
+
+        backend.client.download = mock.Mock(side_effect=download)
+        path = await attachment.fetch()
+        self.assertEqual(os.path.dirname(path), os.path.join(self.bot_config.BOT_DATA_DIR, "matrix_nio_media"))
+        await attachment.fetch()
+        backend.client.download.assert_called_once()
+
+    async def test_matrix_nio_backend_attachment_path_on_loop(self):
+        self.bot_config.BOT_DATA_DIR = tempfile.mkdtemp()
+        self.bot_config.MATRIX_NIO_ATTACHMENTS = True
+        self.bot_config.MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        # As set up by serve_once: the messages are handled on the loop thread
+        backend.loop = asyncio.get_event_loop()
+        backend._loop_thread = threading.current_thread()
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        backend.client.rooms = {"test_room": test_room}
+        backend.client.download = mock.Mock()
+        errors = []
+
+        def callback_message(msg):
+            try:
+                msg.extras["attachment"].path()
+            except ValueError as error:
+                errors.append(error)
+
+        backend.callback_message = callback_message
+        backend.handle_message(test_room, nio.RoomMessageFile.from_dict({
+            "content": {"body": "report.pdf", "msgtype": "m.file", "url": "mxc://matrix.org/report"},
+            "event_id": "$attachment",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "type": "m.room.message"
+        }))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("await it instead", str(errors[0]))
+        backend.client.download.assert_not_called()
+
+    def test_matrix_nio_backend_handle_power_levels(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        test_room.power_levels.users["@example:localhost"] = 50
+        backend.client.rooms = {"test_room": test_room}
+        backend.callback_message = mock.Mock()
+        test_message = RoomMessageText.from_dict({
+            "content": {
+                "body": "Test message",
+                "msgtype": "m.text"
+            },
+            "event_id": "$message",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "type": "m.room.message"
+        })
+        backend.handle_message(test_room, test_message)
+        self.assertEqual(backend.callback_message.call_args[0][0].frm.power_level, 50)
+        backend.handle_power_levels(test_room, nio.PowerLevelsEvent.from_dict({
+            "content": {"users": {"@example:localhost": 100}},
+            "event_id": "$power_levels",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "state_key": "",
+            "type": "m.room.power_levels"
+        }))
+        self.assertEqual(backend.room_power_levels(test_room).get("@example:localhost"), 100)
+
     def test_matrix_nio_backend_handle_unsupported_message(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org",
@@ -734,6 +1932,183 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         backend.client.room_send.assert_called_once()
         # TODO: Add assert called once with
 
+    async def check_editable_message(self, backend, to, room_id):
+        backend.loop = asyncio.get_event_loop()
+        event_id = "1234567890"
+        backend.client.room_send = mock.Mock(
+            side_effect=lambda **kwargs: aiounittest.futurized(
+                RoomSendResponse.from_dict({"event_id": event_id}, kwargs["room_id"])
+            )
+        )
+        test_message = Message("Progress: 0%")
+        test_message.to = to
+        editable = backend.send_editable_message(test_message)
+        self.assertEqual(await editable.event_id(), event_id)
+        self.assertEqual(editable.room_id, room_id)
+        for progress in range(1, 101):
+            editable.update(f"Progress: {progress}%")
+        await asyncio.sleep(0)
+        await editable.flush()
+        # One original message and a single coalesced edit, both in the same room
+        self.assertEqual(backend.client.room_send.call_count, 2)
+        self.assertEqual(backend.client.room_send.call_args[1]["room_id"], room_id)
+        edit_content = backend.client.room_send.call_args[1]["content"]
+        self.assertEqual(edit_content["m.new_content"]["body"], "Progress: 100%")
+        self.assertEqual(edit_content["m.relates_to"], {"rel_type": "m.replace", "event_id": event_id})
+        self.assertEqual(editable.body, "Progress: 100%")
+
+    async def test_matrix_nio_backend_send_editable_message(self):
+        self.bot_config.MATRIX_NIO_EDIT_INTERVAL = 50
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.rooms = {"!test_room:matrix.org": nio.MatrixRoom("!test_room:matrix.org", "test_user")}
+        room = matrix_nio.MatrixNioRoom("!test_room:matrix.org", client=backend.client, title="A title")
+        await self.check_editable_message(backend, room, "!test_room:matrix.org")
+
+    async def test_matrix_nio_backend_send_editable_message_to_person(self):
+        self.bot_config.MATRIX_NIO_EDIT_INTERVAL = 50
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.direct_rooms["@someone:matrix.org"] = "!direct:matrix.org"
+        person = matrix_nio.MatrixNioPerson("@someone:matrix.org", client=backend.client, full_name="Someone")
+        await self.check_editable_message(backend, person, "!direct:matrix.org")
+
+    async def test_matrix_nio_backend_send_editable_message_failed(self):
+        self.bot_config.MATRIX_NIO_EDIT_INTERVAL = 0
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.loop = asyncio.get_event_loop()
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_send = mock.Mock(
+            side_effect=lambda **kwargs: aiounittest.futurized(nio.RoomSendError.from_dict({}, kwargs["room_id"]))
+        )
+        test_message = Message("Progress: 0%")
+        backend.client.rooms = {"!test_room:matrix.org": nio.MatrixRoom("!test_room:matrix.org", "test_user")}
+        test_message.to = matrix_nio.MatrixNioRoom("!test_room:matrix.org", client=backend.client, title="A title")
+        editable = backend.send_editable_message(test_message)
+        with self.assertRaises(ValueError):
+            await editable.event_id()
+        editable.update("Progress: 50%")
+        await asyncio.sleep(0.01)
+        await editable.flush()
+        # The edits of a message that was never sent are dropped instead of retried
+        self.assertEqual(backend.client.room_send.call_count, 1)
+        self.assertIsNone(editable.room_id)
+        self.assertEqual(editable.body, "Progress: 0%")
+
+    async def test_matrix_nio_backend_admin_command_priority(self):
+        self.bot_config.BOT_ADMINS = ("@admin:example.org",)
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.rooms = {"test_room": MatrixRoom("test_room", "test_user")}
+        backend.commands = {"restart": mock.Mock(_err_command_admin_only=True),
+                            "help": mock.Mock(_err_command_admin_only=False)}
+        room_sends = []
+
+        async def room_send(room_id, content, priority=False):
+            room_sends.append(priority)
+            return RoomSendResponse.from_dict({"event_id": "$event"}, room_id)
+
+        backend._room_send = room_send
+        backend.direct_rooms["@admin:example.org"] = "direct_room"
+        admin = matrix_nio.MatrixNioRoomOccupant("@admin:example.org", client=backend.client, full_name="Admin",
+                                                 emails=["@admin:example.org"], room="test_room")
+        room = matrix_nio.MatrixNioRoom("test_room", client=backend.client, title="A title")
+        with mock.patch.object(ErrBot, "_process_command"):
+            for command, private in [("restart", False), ("restart", True), ("help", False)]:
+                msg = Message(f"!{command}", frm=admin, to=room)
+                backend._process_command(msg, command, "", None)
+                await backend._send_message(backend.build_reply(msg, "Done", private=private))
+        # Only the replies to admin commands jump the queue, not any reply to an admin
+        self.assertEqual(room_sends, [True, True, False])
+
+    async def test_matrix_nio_backend_change_presence(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.loop = asyncio.get_event_loop()
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.set_presence = mock.Mock(
+            side_effect=lambda *args: aiounittest.futurized(nio.responses.PresenceSetResponse())
+        )
+        backend.change_presence(matrix_nio.ONLINE, "Starting")
+        backend.change_presence(matrix_nio.AWAY, "Busy")
+        backend.change_presence(matrix_nio.DND, "Very busy")
+        await asyncio.sleep(0)
+        await backend._presence_task
+        # All three changes were requested before the update ran, only the latest one is sent
+        backend.client.set_presence.assert_called_once_with("unavailable", "Very busy")
+
+    async def test_matrix_nio_backend_typing_notifications(self):
+        self.bot_config.MATRIX_NIO_TYPING_NOTIFICATIONS = True
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.loop = asyncio.get_event_loop()
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_typing = mock.Mock(
+            side_effect=lambda *args, **kwargs: aiounittest.futurized(nio.responses.RoomTypingResponse("test_room"))
+        )
+        for _ in range(10):
+            backend._start_typing("test_room")
+        backend._start_typing("other_test_room")
+        await asyncio.sleep(0.01)
+        backend.client.room_typing.assert_has_calls([
+            call("test_room", True, timeout=30000),
+            call("other_test_room", True, timeout=30000)
+        ])
+        self.assertEqual(backend.client.room_typing.call_count, 2)
+
+    def test_matrix_nio_backend_typing_notifications_commands_only(self):
+        self.bot_config.MATRIX_NIO_TYPING_NOTIFICATIONS = True
+        self.bot_config.BOT_ALT_PREFIXES = ("@bot",)
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        backend.client.rooms = {"test_room": test_room}
+        backend.callback_message = mock.Mock()
+        backend._start_typing = mock.Mock()
+        for index, body in enumerate(["Hello", "BotPrefixhelp", "@Bot help", "Hello @bot"]):
+            backend.handle_message(test_room, nio.RoomMessageText.from_dict({
+                "content": {"msgtype": "m.text", "body": body},
+                "event_id": f"$typing{index}",
+                "origin_server_ts": int(time.time() * 1000),
+                "sender": "@example:localhost",
+                "type": "m.room.message"
+            }))
+        # Only the messages starting with a prefix or an alternate prefix are commands
+        self.assertEqual(backend.callback_message.call_count, 4)
+        self.assertEqual(backend._start_typing.call_args_list, [call("test_room"), call("test_room")])
+
+    async def test_matrix_nio_backend_send_read_markers(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_read_markers = mock.Mock(
+            side_effect=lambda room_id, **kwargs: aiounittest.futurized(
+                nio.responses.RoomReadMarkersResponse(room_id)
+            )
+        )
+        backend.callback_message = mock.Mock()
+        test_room = nio.MatrixRoom("test_room", "test_user")
+        other_test_room = nio.MatrixRoom("other_test_room", "test_user")
+        backend.client.rooms = {"test_room": test_room, "other_test_room": other_test_room}
+        for index in range(100):
+            test_message = RoomMessageText.from_dict({
+                "content": {
+                    "body": f"Message {index}",
+                    "msgtype": "m.text"
+                },
+                "event_id": f"$event{index}",
+                "origin_server_ts": 1516362319505,
+                "sender": "@example:localhost",
+                "type": "m.room.message"
+            })
+            backend.handle_message(test_room if index % 2 else other_test_room, test_message)
+        await backend._send_read_markers()
+        backend.client.room_read_markers.assert_has_calls([
+            call("test_room", fully_read_event="$event99", read_event="$event99"),
+            call("other_test_room", fully_read_event="$event98", read_event="$event98")
+        ], any_order=True)
+        self.assertEqual(backend.client.room_read_markers.call_count, 2)
+        # Nothing new to acknowledge
+        await backend._send_read_markers()
+        self.assertEqual(backend.client.room_read_markers.call_count, 2)
+
     def test_matrix_nio_backend_is_from_self(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         test_user_id = "test_user"
@@ -815,6 +2190,36 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
                 backend.build_identifier(test_id)
             )
 
+    async def test_matrix_nio_backend_prefetch_identifiers(self):
+        self.bot_config.MATRIX_NIO_PROFILE_CONCURRENCY = 2
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+
+        def get_profile(user_id):
+            if user_id == "@unknown:matrix.org":
+                return ProfileGetError.from_dict({"errcode": "M_NOT_FOUND", "error": "Profile not found"})
+            return ProfileGetResponse.from_dict({"displayname": f"Name of {user_id}"})
+
+        backend.client.get_profile = get_profile = ConcurrentCalls(get_profile)
+        user_ids = ["@a:matrix.org", "@b:matrix.org", "@c:matrix.org", "@a:matrix.org", "@unknown:matrix.org"]
+        # A concurrent build_identifier shares the prefetch request
+        identifiers, identifier = await asyncio.gather(
+            backend.prefetch_identifiers(user_ids),
+            backend.build_identifier("@a:matrix.org")
+        )
+        self.assertEqual(list(identifiers), ["@a:matrix.org", "@b:matrix.org", "@c:matrix.org", "@unknown:matrix.org"])
+        self.assertEqual(identifiers["@b:matrix.org"].fullname, "Name of @b:matrix.org")
+        self.assertIsNone(identifiers["@unknown:matrix.org"])
+        self.assertIs(identifier, identifiers["@a:matrix.org"])
+        # Each profile is fetched once, at most MATRIX_NIO_PROFILE_CONCURRENCY at a time
+        self.assertEqual(sorted(get_profile.calls), [
+            call("@a:matrix.org"), call("@b:matrix.org"), call("@c:matrix.org"), call("@unknown:matrix.org")
+        ])
+        self.assertEqual(get_profile.max_running, 2)
+        # Cached from now on
+        self.assertIs(await backend.build_identifier("@c:matrix.org"), identifiers["@c:matrix.org"])
+        self.assertEqual(len(get_profile.calls), 4)
+
     def test_matrix_nio_backend_build_reply(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org",
@@ -835,6 +2240,76 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         self.assertEqual(response.to, test_message.frm)
         self.assertEqual(response.body, f"{message_text}\n{response_text}")
 
+    def test_matrix_nio_backend_build_private_reply(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        test_message = Message("Test message",
+                               matrix_nio.MatrixNioRoomOccupant("an_id",
+                                                                full_name="A name",
+                                                                client=backend.client,
+                                                                room="test_room"))
+        response = backend.build_reply(test_message, "A response", private=True)
+        self.assertEqual(response.to, test_message.frm)
+        self.assertNotIsInstance(response.to, matrix_nio.MatrixNioRoomOccupant)
+
+    def test_matrix_nio_backend_handle_direct_rooms(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.rooms = {"!dm2:example.org": MatrixRoom("!dm2:example.org", "test_user")}
+        backend.handle_account_data(nio.UnknownAccountDataEvent("m.direct", {
+            "@alice:example.org": ["!dm1:example.org", "!dm2:example.org"],
+            "@bob:example.org": ["!left:example.org"]
+        }))
+        self.assertEqual(backend.direct_rooms, {"@alice:example.org": "!dm2:example.org"})
+
+    def test_matrix_nio_backend_first_sync_direct_rooms(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.access_token = True
+        with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+            data = json.loads(json_file.read())
+        data["account_data"] = {"events": [{
+            "type": "m.direct",
+            "content": {"@alice:example.org": ["!SVkFJHzfwvuaIEawgC:localhost"]}
+        }]}
+
+        async def sync(**kwargs):
+            response = SyncResponse.from_dict(data)
+            await backend.client.receive_response(response)
+            return response
+
+        backend.client.sync = sync
+        backend.serve_once()
+        # Only sent again when it changes, the m.direct of the first sync must not be dropped
+        self.assertEqual(backend.direct_rooms, {"@alice:example.org": "!SVkFJHzfwvuaIEawgC:localhost"})
+
+    async def test_matrix_nio_backend_send_private_message(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = matrix_nio.MatrixNioClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_create = mock.Mock(
+            return_value=aiounittest.futurized(nio.responses.RoomCreateResponse("!dm:example.org"))
+        )
+        backend.client.set_direct_rooms = mock.Mock(
+            return_value=aiounittest.futurized(nio.responses.EmptyResponse())
+        )
+        backend.client.room_send = mock.Mock(
+            side_effect=lambda **kwargs: aiounittest.futurized(
+                RoomSendResponse.from_dict({"event_id": "$event"}, kwargs["room_id"])
+            )
+        )
+        person = matrix_nio.MatrixNioPerson("@alice:example.org", client=backend.client, full_name="Alice")
+        messages = []
+        for index in range(3):
+            message = Message(f"Message {index}")
+            message.to = person
+            messages.append(backend._send_message(message))
+        results = await asyncio.gather(*messages)
+        # Concurrent private messages share a single room creation
+        backend.client.room_create.assert_called_once()
+        backend.client.set_direct_rooms.assert_called_once_with({"@alice:example.org": ["!dm:example.org"]})
+        self.assertEqual([result.room_id for result in results], ["!dm:example.org"] * 3)
+        self.assertEqual(backend.direct_rooms, {"@alice:example.org": "!dm:example.org"})
+
     def test_matrix_nio_backend_mode(self):
         mode = matrix_nio.MatrixNioBackend(self.bot_config).mode
         self.assertEqual(mode, "matrix-nio")
@@ -854,6 +2329,214 @@ class TestMatrixNioBackend(aiounittest.AsyncTestCase):
         self.assertEqual(result_room1.id, room_id1)
         self.assertEqual(result_room2.id, room_id2)
 
+    async def test_matrix_nio_backend_resolve_room_aliases(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.room_resolve_alias = mock.Mock(
+            side_effect=lambda alias: aiounittest.futurized(
+                nio.responses.RoomResolveAliasResponse(alias, alias.replace("#", "!"), ["example.org"])
+                if alias != "#unknown:example.org"
+                else nio.responses.RoomResolveAliasError("Room alias not found")
+            )
+        )
+        backend.aliases.put("#cached:example.org", "!cached:example.org")
+        result = await backend.resolve_room_aliases([
+            "#ops:example.org", "#dev:example.org", "#ops:example.org", "#cached:example.org", "#unknown:example.org"
+        ])
+        self.assertEqual(result, {
+            "#ops:example.org": "!ops:example.org",
+            "#dev:example.org": "!dev:example.org",
+            "#cached:example.org": "!cached:example.org",
+            "#unknown:example.org": None
+        })
+        self.assertEqual(backend.client.room_resolve_alias.call_count, 3)
+        self.assertEqual(await backend.resolve_room_alias("#ops:example.org"), "!ops:example.org")
+        self.assertEqual(backend.client.room_resolve_alias.call_count, 3)
+
+    async def test_matrix_nio_backend_broadcast(self):
+        self.bot_config.MATRIX_NIO_BROADCAST_CONCURRENCY = 3
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="@test_user:test.matrix.org", device_id="test_device")
+        backend.client.room_resolve_alias = mock.Mock(
+            side_effect=lambda alias: aiounittest.futurized(
+                nio.responses.RoomResolveAliasResponse(alias, "!ops:example.org", ["example.org"])
+                if alias == "#ops:example.org"
+                else nio.responses.RoomResolveAliasError("Room alias not found")
+            )
+        )
+        backend.direct_rooms["@alice:example.org"] = "!alice:example.org"
+
+        def room_send(room_id, message_type, content):
+            if room_id == "!failing:example.org":
+                return nio.RoomSendError("Forbidden")
+            return RoomSendResponse.from_dict({"event_id": f"$event_{room_id}"}, room_id)
+
+        backend.client.room_send = room_send = ConcurrentCalls(room_send)
+        rooms = [f"!room{index}:example.org" for index in range(10)]
+        person = matrix_nio.MatrixNioPerson("@alice:example.org", client=backend.client, emails=[], full_name="")
+        outcomes = await backend.broadcast("Announcement", rooms + [
+            rooms[0], "#ops:example.org", "#unknown:example.org", person, "!failing:example.org"
+        ])
+        self.assertEqual(len(outcomes), 14)
+        self.assertEqual(outcomes["!room3:example.org"].event_id, "$event_!room3:example.org")
+        self.assertEqual(outcomes["!ops:example.org"].event_id, "$event_!ops:example.org")
+        self.assertEqual(outcomes["!alice:example.org"].event_id, "$event_!alice:example.org")
+        self.assertIsInstance(outcomes["#unknown:example.org"], matrix_nio.MatrixNioRoomError)
+        self.assertIsInstance(outcomes["!failing:example.org"], ValueError)
+        # Duplicates are sent once, at most MATRIX_NIO_BROADCAST_CONCURRENCY at a time
+        self.assertEqual(len(room_send.calls), 13)
+        self.assertEqual(room_send.max_running, 3)
+        # The content is rendered once
+        contents = [kwargs["content"] for _, _, kwargs in room_send.calls]
+        self.assertTrue(all(content is contents[0] for content in contents))
+
+    async def test_matrix_nio_backend_broadcast_timeout(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="@test_user:test.matrix.org", device_id="test_device")
+
+        async def room_send(room_id, message_type, content):
+            if room_id == "!slow:example.org":
+                await asyncio.sleep(10)
+            return RoomSendResponse.from_dict({"event_id": "$event"}, room_id)
+
+        backend.client.room_send = mock.Mock(side_effect=room_send)
+        start = time.monotonic()
+        outcomes = await backend.broadcast("Announcement", ["!fast:example.org", "!slow:example.org"], timeout=0.05)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIsInstance(outcomes["!fast:example.org"], RoomSendResponse)
+        self.assertIsInstance(outcomes["!slow:example.org"], asyncio.TimeoutError)
+        self.assertFalse(backend._pending_sends)
+
+    async def test_matrix_nio_backend_send_broadcast(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="@test_user:test.matrix.org", device_id="test_device")
+        backend.client.room_send = mock.Mock(side_effect=lambda room_id, message_type, content: aiounittest.futurized(
+            RoomSendResponse.from_dict({"event_id": "$event"}, room_id)))
+        backend.loop = asyncio.get_event_loop()
+        backend._loop_thread = threading.current_thread()
+        # From a plugin thread
+        outcomes = await backend.loop.run_in_executor(None, backend.send_broadcast, "Announcement", ["!a:example.org"])
+        self.assertIsInstance(outcomes["!a:example.org"], RoomSendResponse)
+        # From callback_message, on the loop thread
+        with self.assertRaises(ValueError):
+            backend.send_broadcast("Announcement", ["!a:example.org"])
+        backend.client.room_send.assert_called_once()
+
+    def test_matrix_nio_backend_invite_allowed(self):
+        self.bot_config.BOT_ADMINS = ("@admin:example.org",)
+        self.bot_config.MATRIX_NIO_INVITE_USERS = ["@alice:other.org"]
+        self.bot_config.MATRIX_NIO_INVITE_SERVERS = ["example.org"]
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        self.assertTrue(backend.invite_allowed("@admin:example.org"))
+        self.assertTrue(backend.invite_allowed("@alice:other.org"))
+        self.assertTrue(backend.invite_allowed("@bob:example.org"))
+        self.assertFalse(backend.invite_allowed("@bob:other.org"))
+        self.assertFalse(backend.invite_allowed("@bob:example.org.evil.com"))
+
+    async def test_matrix_nio_backend_accept_invites(self):
+        self.bot_config.MATRIX_NIO_AUTO_ACCEPT_INVITES = True
+        self.bot_config.MATRIX_NIO_INVITE_SERVERS = ["example.org"]
+        self.bot_config.MATRIX_NIO_INVITE_CONCURRENCY = 2
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="@bot:example.org", device_id="test_device")
+        backend.client.user_id = "@bot:example.org"
+
+        def join(room_id):
+            if room_id == "!gone:example.org":
+                return nio.responses.JoinError("Room not found")
+            return nio.responses.JoinResponse(room_id)
+
+        def room_get_state(room_id):
+            return aiounittest.futurized(nio.responses.RoomGetStateResponse.from_dict([
+                {"type": "m.room.canonical_alias", "sender": "@alice:example.org", "state_key": "",
+                 "event_id": "$alias", "origin_server_ts": 1,
+                 "content": {"alias": room_id.replace("!", "#")}},
+                {"type": "m.room.member", "sender": "@alice:example.org", "state_key": "@alice:example.org",
+                 "event_id": "$member", "origin_server_ts": 1,
+                 "content": {"membership": "join", "displayname": "Alice"}},
+                {"type": "m.room.power_levels", "sender": "@alice:example.org", "state_key": "",
+                 "event_id": "$power_levels", "origin_server_ts": 1,
+                 "content": {"users": {"@alice:example.org": 100}}}
+            ], room_id))
+
+        backend.client.join = join = ConcurrentCalls(join)
+        backend.client.room_get_state = mock.Mock(side_effect=room_get_state)
+        backend.client.get_profile = mock.Mock(
+            return_value=aiounittest.futurized(ProfileGetResponse.from_dict({"displayname": "Alice"}))
+        )
+        backend._add_callbacks()
+
+        def invite(room_id, sender, state_key="@bot:example.org"):
+            return room_id, nio.InviteEvent.parse_event({
+                "type": "m.room.member", "sender": sender, "state_key": state_key,
+                "content": {"membership": "invite"}
+            })
+
+        invites = [
+            invite("!room1:example.org", "@alice:example.org"),
+            invite("!room2:example.org", "@alice:example.org"),
+            invite("!room3:example.org", "@alice:example.org"),
+            invite("!room3:example.org", "@alice:example.org"),
+            invite("!gone:example.org", "@alice:example.org"),
+            invite("!spam:other.org", "@spammer:other.org"),
+            invite("!other:example.org", "@alice:example.org", state_key="@carol:example.org")
+        ]
+        for room_id, event in invites:
+            # Delivered the way a sync response does
+            response = mock.Mock(rooms=mock.Mock(invite={room_id: mock.Mock(invite_state=[event])}))
+            await backend.client._handle_invited_rooms(response)
+        await backend._invite_batch
+        await asyncio.gather(*backend._room_warm_ups)
+        # Allowed invites are joined once, at most MATRIX_NIO_INVITE_CONCURRENCY at a time
+        self.assertEqual(sorted(join.calls), [
+            call("!gone:example.org"), call("!room1:example.org"),
+            call("!room2:example.org"), call("!room3:example.org")
+        ])
+        self.assertEqual(join.max_running, 2)
+        self.assertEqual(sorted(backend.client.rooms),
+                         ["!room1:example.org", "!room2:example.org", "!room3:example.org"])
+        # Warmed up: members, power levels, alias and the inviter's profile
+        room = backend.client.rooms["!room2:example.org"]
+        self.assertEqual(room.users["@alice:example.org"].display_name, "Alice")
+        self.assertEqual(backend.power_levels["!room2:example.org"].get("@alice:example.org"), 100)
+        self.assertEqual(backend.aliases.get("#room2:example.org"), "!room2:example.org")
+        self.assertIsNotNone(backend.identifiers.get("@alice:example.org"))
+        backend.client.get_profile.assert_called_once()
+        self.assertIsNone(backend._invite_batch)
+
+    async def test_matrix_nio_backend_query_room_joined(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        backend.client.rooms = {"test_room": MatrixRoom("test_room", "test_user")}
+        backend.loop = asyncio.get_event_loop()
+        backend._loop_thread = threading.current_thread()
+
+        async def joined_rooms():
+            return JoinedRoomsResponse.from_dict({"joined_rooms": ["test_room"]})
+
+        backend.client.joined_rooms = joined_rooms
+        room = backend.query_room("test_room")
+        # From a plugin thread, the request runs on the backend loop
+        self.assertTrue(await backend.loop.run_in_executor(None, lambda: room.joined))
+        with self.assertRaises(ValueError):
+            room.joined
+
+    def test_matrix_nio_backend_query_room_alias(self):
+        backend = matrix_nio.MatrixNioBackend(self.bot_config)
+        backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
+        room_id = "!ops:example.org"
+        test_room = MatrixRoom(room_id, "owner")
+        backend.client.rooms = {room_id: test_room}
+        backend.handle_canonical_alias(test_room, nio.RoomAliasEvent.from_dict({
+            "content": {"alias": "#ops:example.org"},
+            "event_id": "$canonical_alias",
+            "origin_server_ts": 1516362319505,
+            "sender": "@example:localhost",
+            "state_key": "",
+            "type": "m.room.canonical_alias"
+        }))
+        self.assertEqual(backend.query_room("#ops:example.org").id, room_id)
+
     def test_matrix_nio_backend_query_empty_room(self):
         backend = matrix_nio.MatrixNioBackend(self.bot_config)
         backend.client = nio.AsyncClient("test.matrix.org", user="test_user", device_id="test_device")
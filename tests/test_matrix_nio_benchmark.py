@@ -0,0 +1,135 @@
+import asyncio
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import nio
+import pytest
+
+import matrix_nio
+
+ROOMS = 500
+MESSAGES = 1000
+
+
+@pytest.fixture(scope="module")
+def sync_body() -> bytes:
+    """
+    tests/sync.json with its joined room replicated in order to reach the size of a busy account's sync
+    """
+    with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+        data = json.load(json_file)
+    room_id, room = next(iter(data["rooms"]["join"].items()))
+    for i in range(ROOMS):
+        data["rooms"]["join"][f"{room_id}{i}"] = copy.deepcopy(room)
+    return json.dumps(data).encode()
+
+
+@pytest.mark.benchmark(group="sync-json")
+def test_benchmark_sync_json_stdlib(benchmark, sync_body):
+    result = benchmark(json.loads, sync_body)
+    assert len(result["rooms"]["join"]) == ROOMS + 1
+
+
+@pytest.mark.benchmark(group="sync-json")
+def test_benchmark_sync_json_fast(benchmark, sync_body):
+    result = benchmark(matrix_nio.json_loads, sync_body)
+    assert len(result["rooms"]["join"]) == ROOMS + 1
+
+
+@pytest.fixture(scope="module")
+def recorded_traffic() -> str:
+    """
+    A recorded log made of tests/sync.json followed by one message per sync
+    """
+    with open(os.path.join(os.path.dirname(__file__), "sync.json")) as json_file:
+        first_sync = json.load(json_file)
+    room_id = next(iter(first_sync["rooms"]["join"]))
+    path = os.path.join(tempfile.mkdtemp(), "traffic.log.gz")
+    recorder = matrix_nio.MatrixNioRecorder(path)
+    recorder.record("sync", response=first_sync)
+    for i in range(MESSAGES):
+        sync = copy.deepcopy(first_sync)
+        sync["next_batch"] = f"batch_{i}"
+        sync["rooms"]["join"][room_id]["state"]["events"] = []
+        sync["rooms"]["join"][room_id]["timeline"]["events"][0]["event_id"] = f"$message{i}"
+        recorder.record("sync", response=sync)
+    recorder.close()
+    return path
+
+
+@pytest.fixture(params=["asyncio", "uvloop"])
+def event_loop_name(request) -> str:
+    if request.param == "uvloop":
+        pytest.importorskip("uvloop")
+    return request.param
+
+
+def _backend(**options) -> matrix_nio.MatrixNioBackend:
+    class Configuration(object):
+        BOT_IDENTITY = {"email": "test@test.org", "site": "https://test.test.org", "auth_dict": {}}
+        BOT_ASYNC = False
+        BOT_PREFIX = "!"
+        BOT_ALT_PREFIXES = ()
+        BOT_ALT_PREFIX_CASEINSENSITIVE = False
+        MATRIX_NIO_READ_MARKERS_INTERVAL = 0
+
+    configuration = Configuration()
+    for name, value in options.items():
+        setattr(configuration, name, value)
+    backend = matrix_nio.MatrixNioBackend(configuration)
+    backend.client = nio.AsyncClient("test.matrix.org", user="@test:localhost", device_id="test_device")
+    backend.callback_message = lambda message: None
+    return backend
+
+
+def _replay(path: str, event_loop_name: str) -> None:
+    loop = matrix_nio._new_event_loop(event_loop_name)
+    try:
+        loop.run_until_complete(_backend().replay(path, speed=None))
+    finally:
+        loop.close()
+
+
+@pytest.mark.benchmark(group="replay")
+def test_benchmark_replay(benchmark, recorded_traffic, event_loop_name):
+    benchmark.pedantic(_replay, args=(recorded_traffic, event_loop_name), rounds=5)
+
+
+@pytest.mark.benchmark(group="send-latency")
+def test_benchmark_send_latency(benchmark, event_loop_name):
+    backend = _backend(MATRIX_NIO_SEND_RATE=1000000, MATRIX_NIO_SEND_BURST=1000000)
+
+    async def room_send(room_id, message_type, content):
+        await asyncio.sleep(0)
+        return nio.RoomSendResponse.from_dict({"event_id": "$event"}, room_id)
+
+    backend.client.room_send = room_send
+    loop = matrix_nio._new_event_loop(event_loop_name)
+    try:
+        result = benchmark(lambda: loop.run_until_complete(
+            backend._room_send("!room:localhost", {"msgtype": "m.text", "body": "Hello"})))
+    finally:
+        loop.close()
+    assert result.event_id == "$event"
+
+
+def _import_matrix_nio() -> None:
+    subprocess.run([sys.executable, "-c", "import matrix_nio"], check=True)
+
+
+def _start_matrix_nio() -> None:
+    subprocess.run([sys.executable, "-c", "import matrix_nio; matrix_nio._load_nio()"], check=True)
+
+
+@pytest.mark.benchmark(group="import")
+def test_benchmark_import(benchmark):
+    benchmark.pedantic(_import_matrix_nio, rounds=5)
+
+
+@pytest.mark.benchmark(group="import")
+def test_benchmark_import_and_load_nio(benchmark):
+    benchmark.pedantic(_start_matrix_nio, rounds=5)
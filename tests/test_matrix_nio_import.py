@@ -1,24 +1,40 @@
 import unittest
+import subprocess
 import sys
 import importlib
 
 
 class TestImports(unittest.TestCase):
+    def tearDown(self) -> None:
+        import matrix_nio
+        importlib.reload(matrix_nio)
+
     def test_import_asyncio_error(self):
         import matrix_nio
         module_svg = sys.modules["asyncio"]
         sys.modules["asyncio"] = None
-        with self.assertRaises(SystemExit):
-            importlib.reload(matrix_nio)
-        sys.modules["asyncio"] = module_svg
+        try:
+            with self.assertRaises(SystemExit):
+                importlib.reload(matrix_nio)
+        finally:
+            sys.modules["asyncio"] = module_svg
 
     def test_import_nio_error(self):
         import matrix_nio
         module_svg = sys.modules["nio"]
         sys.modules["nio"] = None
-        with self.assertRaises(SystemExit):
+        try:
             importlib.reload(matrix_nio)
-        sys.modules["nio"] = module_svg
+            with self.assertRaises(SystemExit):
+                matrix_nio._load_nio()
+        finally:
+            sys.modules["nio"] = module_svg
+
+    def test_import_is_lazy(self):
+        loaded = subprocess.check_output(
+            [sys.executable, "-c", "import sys, matrix_nio; print('nio.api' in sys.modules)"]
+        ).decode().strip()
+        self.assertEqual(loaded, "False")
 
 
 if __name__ == '__main__':